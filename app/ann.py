@@ -0,0 +1,118 @@
+import numpy as np
+
+# Below this many rows exact search is fast enough that ANN isn't worth it
+ANN_MIN_SIZE = 10000
+
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, scores.size)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def merge_top_k(results, k):
+    """Best k (rows, scores) across several partial top-k results"""
+    rows = np.concatenate([r for r, _ in results])
+    scores = np.concatenate([np.asarray(s, dtype=np.float32) for _, s in results])
+    top = top_k(scores, k)
+    return rows[top], scores[top]
+
+
+def _assign(matrix, centroids, chunk_size=65536):
+    """Nearest centroid (by inner product) for every row, in chunks"""
+    labels = np.empty(matrix.shape[0], dtype=np.int32)
+    for start in range(0, matrix.shape[0], chunk_size):
+        block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        labels[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+class IVFIndex:
+    """
+    Inverted-file approximate nearest-neighbour index over unit-length vectors
+
+    Rows are clustered with spherical k-means; a query scores the centroids,
+    probes the `nprobe` closest lists and scores only the rows in them
+    exactly. Raising `nprobe` trades latency for recall, up to an exhaustive
+    search when it reaches `n_lists`.
+    """
+
+    def __init__(self, centroids, offsets, rows):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, n_iter=10, sample_size=100000, seed=0):
+        """Cluster the rows of a normalized embedding matrix into inverted lists"""
+        n = matrix.shape[0]
+        n_lists = int(n_lists or max(1, round(np.sqrt(n))))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+
+        sample_rows = np.sort(rng.choice(n, size=min(n, max(sample_size, n_lists)), replace=False))
+        sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+        centroids = sample[rng.choice(sample.shape[0], size=n_lists, replace=False)].copy()
+
+        for _ in range(n_iter):
+            labels = _assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+
+            # Re-seed empty lists from random sample rows
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        labels = _assign(matrix, centroids)
+        order = np.argsort(labels, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(labels, minlength=n_lists))
+        return cls(centroids, offsets, order)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, offsets=self.offsets, rows=self.rows)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['offsets'], data['rows'])
+
+    def candidates(self, query, nprobe):
+        """Rows in the `nprobe` lists closest to the query"""
+        probe = top_k(self.centroids @ query, min(nprobe, self.n_lists))
+        return np.concatenate([self.rows[self.offsets[p]:self.offsets[p + 1]] for p in probe])
+
+    def search(self, matrix, query, k, nprobe=8, mask=None):
+        """
+        Approximate top-k rows for a query
+
+        Args:
+            matrix: Normalized embedding matrix the index was built from
+            query: Unit-length query vector
+            k: Number of results
+            nprobe: Number of inverted lists to scan
+            mask: Optional boolean row mask applied to the scanned candidates
+
+        Returns:
+            (rows, scores) ordered best first; fewer than k if the probed
+            lists hold fewer matching rows
+        """
+        rows = self.candidates(query, nprobe)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        rows = np.sort(rows)
+        scores = np.asarray(matrix[rows] @ query, dtype=np.float32)
+        top = top_k(scores, k)
+        return rows[top], scores[top]
@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+
+class QueryBatcher:
+    """
+    Collects concurrent queries for a few milliseconds and encodes them together
+
+    Callers await `encode(text)`; a single background task drains the queue,
+    sends up to `max_batch_size` texts to `encode_batch` in one call (run in a
+    worker thread via `run_blocking`) and resolves each caller's future with
+    its own row.
+    """
+
+    def __init__(self, encode_batch, max_batch_size=32, max_wait_ms=5.0, run_blocking=asyncio.to_thread):
+        self.encode_batch = encode_batch
+        self.run_blocking = run_blocking
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue = None
+        self._task = None
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def encode(self, text):
+        """Encode one text as part of the next batch"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _collect(self):
+        """Wait for one item, then gather more until the batch is full or the wait expires"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+
+            # Callers that gave up while queued don't need encoding
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+
+            try:
+                vectors = await self.run_blocking(self.encode_batch, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
@@ -0,0 +1,102 @@
+"""
+Offline builder for the embedding index served by SHLRecommender
+
+Usage:
+    python -m app.build_index [--catalog PATH] [--manifest PATH] [--backend NAME] [--batch-size N]
+                              [--ann | --no-ann] [--ann-lists N]
+"""
+import argparse
+import json
+import os
+import time
+from app.ann import ANN_MIN_SIZE, IVFIndex
+from app.catalog import Catalog
+from app.embedding_builder import EmbeddingBuilder, embedding_text
+from app.encoders import ENCODER_BACKEND, make_encoder
+from app.lexical import BM25Index
+from app.index_store import (
+    MANIFEST_PATH,
+    MODEL_NAME,
+    IndexArtifactError,
+    load_index,
+    normalize_rows,
+    save_index
+)
+
+CATALOG_PATH = 'data/processed/shl_assessments_detailed.json'
+
+
+def build_index(catalog_path=CATALOG_PATH, manifest_path=MANIFEST_PATH,
+                model_name=MODEL_NAME, batch_size=32, encoder=None, ann=None, ann_lists=None,
+                encoder_backend=ENCODER_BACKEND):
+    """
+    Encode new or edited assessments and write a fresh index artifact
+
+    An IVF ANN index is built alongside the embeddings when `ann` is True,
+    or by default once the catalog reaches ANN_MIN_SIZE assessments. The
+    BM25 postings of the same texts are always stored with them.
+    """
+    with open(catalog_path, 'r', encoding='utf-8') as f:
+        assessments = list(Catalog(json.load(f)).records())
+
+    encoder = encoder or make_encoder(encoder_backend, model_name)
+    model_name = encoder.index_name
+
+    # Reuse the previous build when it is intact and made with the same model
+    previous_matrix, previous_manifest = None, None
+    try:
+        previous_matrix, previous_manifest = load_index(manifest_path)
+        if previous_manifest['model'] != model_name:
+            previous_matrix, previous_manifest = None, None
+    except IndexArtifactError as e:
+        print(f"Starting a full build: {e}")
+
+    builder = EmbeddingBuilder(encoder, batch_size=batch_size)
+    matrix, ids, hashes, stats = builder.build(assessments, previous_matrix, previous_manifest)
+    print(f"Embeddings: {stats['encoded']} encoded, {stats['reused']} reused")
+
+    if ann is None:
+        ann = len(ids) >= ANN_MIN_SIZE
+
+    if (previous_manifest and previous_manifest['ids'] == ids and previous_manifest['hashes'] == hashes
+            and bool(previous_manifest.get('ann_file')) == ann and previous_manifest.get('int8_file')
+            and previous_manifest.get('lexical_files')):
+        print(f"Index {previous_manifest['version']} is already up to date")
+        return previous_manifest
+
+    ann_index = None
+    if ann and len(ids):
+        start = time.perf_counter()
+        ann_index = IVFIndex.build(normalize_rows(matrix), n_lists=ann_lists)
+        print(f"Built IVF index with {ann_index.n_lists} lists in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    lexical = BM25Index.build(embedding_text(a) for a in assessments)
+    print(f"Built BM25 postings for {len(lexical.terms)} terms in {time.perf_counter() - start:.1f}s")
+
+    manifest = save_index(matrix, ids, hashes, model_name, manifest_path, ann=ann_index, lexical=lexical)
+    print(f"Wrote index {manifest['version']} ({manifest['count']} x {manifest['dim']}) to {manifest_path}")
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the SHL recommender embedding index")
+    parser.add_argument('--catalog', default=CATALOG_PATH, help="Detailed catalog JSON")
+    parser.add_argument('--manifest', default=MANIFEST_PATH, help="Index manifest to write")
+    parser.add_argument('--model', default=MODEL_NAME, help="Sentence-transformers model name")
+    parser.add_argument('--backend', default=os.environ.get('ENCODER_BACKEND', ENCODER_BACKEND),
+                        help="Encoder backend: sentence-transformers, onnx, onnx-int8 or hash")
+    parser.add_argument('--batch-size', type=int, default=32, help="Assessments encoded per batch")
+    parser.add_argument('--ann', action=argparse.BooleanOptionalAction, default=None,
+                        help=f"Build an IVF ANN index (default: only for {ANN_MIN_SIZE}+ assessments)")
+    parser.add_argument('--ann-lists', type=int, default=None, help="IVF lists (default: sqrt of catalog size)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    build_index(args.catalog, args.manifest, args.model, args.batch_size,
+                ann=args.ann, ann_lists=args.ann_lists, encoder_backend=args.backend)
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def normalize_query(query):
+    """Collapse whitespace and case so trivially different queries share a key"""
+    return ' '.join(str(query).split()).casefold()
+
+
+def _sizeof(value):
+    return getattr(value, 'nbytes', None) or sys.getsizeof(value)
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by entry count and total bytes"""
+
+    def __init__(self, max_entries=1024, max_bytes=None, sizeof=_sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None, valid=None):
+        """Cached value, or `default`; entries failing `valid` (e.g. expired) are dropped as misses"""
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            value = self._data[key][0]
+            if valid is not None and not valid(value):
+                self.bytes -= self._data.pop(key)[1]
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_entries <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self.bytes > self.max_bytes):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DiskResultStore:
+    """
+    Result store in a local directory, shared by every worker on the node
+
+    Each entry is one file named after its key; writes go through a temp file
+    and an atomic rename, and the file mtime drives expiry. Writes are queued
+    to a background thread, which also prunes the directory every
+    `prune_seconds` down to the TTL and the entry and byte limits (oldest
+    first), so the directory stays bounded even if the catalog never changes.
+    `get` reads a file and is meant to be called off the event loop.
+    """
+
+    def __init__(self, directory, ttl_seconds=300, max_entries=10000, max_bytes=256 * 1024 * 1024,
+                 prune_seconds=60, max_queued=1024):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.prune_seconds = prune_seconds
+        self.dropped = 0
+        self.pruned = 0
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._prune_requested = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="result-store-writer", daemon=True)
+        self._writer.start()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, payload):
+        """Queue a write; never blocks, and drops the entry if the writer is behind"""
+        try:
+            self._queue.put_nowait((key, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def request_prune(self):
+        """Prune at the writer's next wake-up instead of waiting for the timer"""
+        self._prune_requested.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _write(self, key, payload):
+        path = self._path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def _run(self):
+        next_prune = time.monotonic() + self.prune_seconds
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, next_prune - time.monotonic()))
+            except queue.Empty:
+                item = None
+            if item is not None:
+                self._write(*item)
+            if self._prune_requested.is_set() or time.monotonic() >= next_prune:
+                self._prune_requested.clear()
+                self.prune()
+                next_prune = time.monotonic() + self.prune_seconds
+
+    def prune(self):
+        """Remove expired entries, then the oldest ones beyond the entry and byte limits"""
+        now = time.time()
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                # Temp files of writers that died mid-write expire the same way
+                if now - stat.st_mtime > self.ttl_seconds:
+                    os.remove(path)
+                    self.pruned += 1
+                elif name.endswith('.json'):
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                pass
+
+        entries.sort(reverse=True)
+        total = 0
+        for i, (_, size, path) in enumerate(entries):
+            total += size
+            if i >= self.max_entries or total > self.max_bytes:
+                try:
+                    os.remove(path)
+                    self.pruned += 1
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {'queued': self._queue.qsize(), 'dropped': self.dropped, 'pruned': self.pruned}
+
+
+class ResultCache:
+    """
+    Cache of serialized /recommend responses with TTL and size limits
+
+    Keys include the catalog snapshot version. `current_version` returns
+    the version being served: the in-memory entries are dropped once when
+    it changes, and requests still running on an older snapshot get misses
+    and don't store their results, so they can't wipe the new snapshot's
+    entries. Without it, a version counts as current when it is first seen. An optional DiskResultStore shares entries
+    across worker processes; `lookup` reads it in a worker thread and
+    `put` hands writes to its writer thread, so the event loop never
+    touches the disk.
+    """
+
+    def __init__(self, ttl_seconds=300, max_entries=2048, max_bytes=32 * 1024 * 1024, disk=None,
+                 current_version=None):
+        self.ttl_seconds = ttl_seconds
+        self.current_version = current_version
+        self.version = None
+        self._seen = OrderedDict()
+        self._version_lock = threading.Lock()
+        self.disk = disk
+        self.disk_hits = 0
+        self._lru = LRUCache(max_entries=max_entries, max_bytes=max_bytes,
+                             sizeof=lambda entry: len(entry[1]))
+
+    @staticmethod
+    def make_key(version, query, **filters):
+        """Stable key for a query and its filters under one index version"""
+        parts = {'version': version, 'query': normalize_query(query), **filters}
+        if parts.get('languages'):
+            parts['languages'] = sorted(parts['languages'])
+        blob = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def _is_current(self, version):
+        """False for a snapshot that is no longer served; clears the cache once on a new one"""
+        if self.current_version is not None:
+            current = self.current_version()
+        elif version == self.version:
+            return True
+        else:
+            with self._version_lock:
+                # Older snapshots were seen before the current one; a new version wasn't
+                current = self.version if version in self._seen else version
+                self._seen[version] = None
+                if len(self._seen) > 64:
+                    self._seen.popitem(last=False)
+        if version != current:
+            return False
+        with self._version_lock:
+            if version != self.version:
+                self._lru.clear()
+                self.version = version
+                if self.disk is not None:
+                    self.disk.request_prune()
+        return True
+
+    def get(self, key, version):
+        """In-memory lookup only"""
+        if not self._is_current(version):
+            return None
+        entry = self._lru.get(key, valid=lambda entry: time.monotonic() < entry[0])
+        return entry[1] if entry is not None else None
+
+    async def lookup(self, keys, version):
+        """Payloads (or None) for several keys, reading memory misses from the disk store off the loop"""
+        payloads = [self.get(key, version) for key in keys]
+        missing = [i for i, payload in enumerate(payloads) if payload is None]
+        if self.disk is None or not missing or version != self.version:
+            return payloads
+
+        found = await asyncio.to_thread(lambda: [self.disk.get(keys[i]) for i in missing])
+        for i, payload in zip(missing, found):
+            if payload is not None:
+                self.disk_hits += 1
+                self._lru.put(keys[i], (time.monotonic() + self.ttl_seconds, payload))
+                payloads[i] = payload
+        return payloads
+
+    def put(self, key, version, payload):
+        if not self._is_current(version):
+            return
+        self._lru.put(key, (time.monotonic() + self.ttl_seconds, payload))
+        if self.disk is not None:
+            self.disk.put(key, payload)
+
+    def stats(self):
+        return {
+            **self._lru.stats(),
+            'disk_hits': self.disk_hits,
+            'disk': self.disk.stats() if self.disk is not None else None,
+            'version': self.version,
+            'shared': self.disk is not None,
+        }
+
+
+class SemanticCache:
+    """
+    Result cache keyed on query meaning rather than query text
+
+    Recent query embeddings sit in a fixed-size ring buffer. A lookup scores
+    the new (unit-length) embedding against all of them in one
+    matrix-vector product and reuses the payload of the closest entry with
+    the same filters when its cosine similarity reaches `threshold`. A lower
+    threshold or a longer TTL gives more hits at the cost of answers that
+    were computed for a slightly different query.
+    """
+
+    def __init__(self, capacity=1024, threshold=0.97, ttl_seconds=300):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._embeddings = None
+        self._filters = [None] * capacity
+        self._payloads = [None] * capacity
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._next = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _reset(self, version):
+        self._filters = [None] * self.capacity
+        self._payloads = [None] * self.capacity
+        self._expires[:] = 0
+        self._next = self._size = 0
+        self.version = version
+
+    def get(self, embedding, filter_key, version):
+        """Payload cached for the most similar earlier query with the same filters"""
+        with self._lock:
+            if version != self.version:
+                self._reset(version)
+            if self._size == 0 or self.capacity <= 0:
+                self.misses += 1
+                return None
+
+            similarities = self._embeddings[:self._size] @ np.asarray(embedding, dtype=np.float32)
+            usable = self._expires[:self._size] > time.monotonic()
+            usable &= np.fromiter((f == filter_key for f in self._filters[:self._size]),
+                                  dtype=bool, count=self._size)
+            similarities[~usable] = -np.inf
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._payloads[best]
+
+    def put(self, embedding, filter_key, version, payload):
+        """Remember a payload, overwriting the oldest entry once the buffer is full"""
+        if self.capacity <= 0:
+            return
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            if version != self.version:
+                self._reset(version)
+            if self._embeddings is None or self._embeddings.shape[1] != embedding.size:
+                self._embeddings = np.zeros((self.capacity, embedding.size), dtype=np.float32)
+                self._reset(version)
+
+            slot = self._next
+            self._embeddings[slot] = embedding
+            self._filters[slot] = filter_key
+            self._payloads[slot] = payload
+            self._expires[slot] = time.monotonic() + self.ttl_seconds
+            self._next = (slot + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'threshold': self.threshold,
+            'ttl_seconds': self.ttl_seconds,
+        }
@@ -0,0 +1,189 @@
+import ast
+import sys
+import numpy as np
+
+# Tri-state flags stored as int8
+UNKNOWN, NO, YES = -1, 0, 1
+
+
+def parse_list_field(value):
+    """List field that may arrive as a list, a Python-repr string or a comma-separated string"""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(v).strip() for v in value if v is not None and str(v).strip()]
+
+    text = str(value).strip()
+    if not text or text in ('None', '[]'):
+        return []
+    if text[0] in '[(':
+        try:
+            return parse_list_field(ast.literal_eval(text))
+        except (ValueError, SyntaxError):
+            text = text.strip('[]()')
+    return [part.strip(" '\"") for part in text.split(',') if part.strip(" '\"")]
+
+
+def parse_bool_field(value):
+    """YES/NO/UNKNOWN from a bool or strings such as 'True', 'yes', '0'"""
+    if value is None:
+        return UNKNOWN
+    if isinstance(value, bool):
+        return YES if value else NO
+    text = str(value).strip().lower()
+    if text in ('true', 'yes', 'y', '1'):
+        return YES
+    if text in ('false', 'no', 'n', '0'):
+        return NO
+    return UNKNOWN
+
+
+def parse_dict_field(value):
+    """Dict field that may arrive as a dict or a Python-repr string"""
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, str) and value.strip().startswith('{'):
+        try:
+            parsed = ast.literal_eval(value)
+            return parsed if isinstance(parsed, dict) else {}
+        except (ValueError, SyntaxError):
+            return {}
+    return {}
+
+
+def parse_duration_minutes(duration_str):
+    """Minutes in a duration string such as '49 minutes'; 0 when unknown"""
+    if not duration_str:
+        return 0
+    try:
+        return int(''.join(filter(str.isdigit, str(duration_str))))
+    except ValueError:
+        return 0
+
+
+def _text(value):
+    return sys.intern(str(value)) if value is not None else None
+
+
+class CategoricalColumn:
+    """
+    Multi-valued categorical column stored as interned codes
+
+    Row i holds codes[offsets[i]:offsets[i + 1]], each an index into
+    `categories`; a single-valued column simply has one code per row.
+    """
+
+    __slots__ = ('categories', 'codes', 'offsets')
+
+    def __init__(self, values_per_row):
+        code_of = {}
+        codes, offsets = [], [0]
+        for values in values_per_row:
+            for value in values:
+                codes.append(code_of.setdefault(sys.intern(value), len(code_of)))
+            offsets.append(len(codes))
+
+        self.categories = list(code_of)
+        self.codes = np.array(codes, dtype=np.int32)
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def row(self, i):
+        return [self.categories[c] for c in self.codes[self.offsets[i]:self.offsets[i + 1]]]
+
+    def masks(self):
+        """One boolean row mask per category"""
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.offsets))
+        masks = {}
+        for code, value in enumerate(self.categories):
+            mask = np.zeros(len(self), dtype=bool)
+            mask[rows[self.codes == code]] = True
+            masks[value] = mask
+        return masks
+
+
+class Catalog:
+    """
+    Typed, columnar view of the assessment catalog
+
+    Stringified fields (Python-repr lists, 'True'/'False' flags, repr'd
+    metadata dicts) are parsed once here; the raw JSON dicts are not kept.
+    `record(i)` rebuilds a plain dict for the few rows a response needs.
+    """
+
+    __slots__ = (
+        'metadata', 'names', 'urls', 'descriptions', 'pdf_links', 'duration_texts',
+        'durations', 'remote_testing', 'adaptive_irt', 'job_levels', 'languages',
+        'test_types', 'row_metadata', '_metadata_values'
+    )
+
+    def __init__(self, catalog_data):
+        assessments = catalog_data.get('assessments', [])
+        self.metadata = parse_dict_field(catalog_data.get('metadata'))
+
+        self.names = [_text(a.get('name')) for a in assessments]
+        self.urls = [_text(a.get('url')) for a in assessments]
+        self.descriptions = [a.get('description') for a in assessments]
+        self.pdf_links = [_text(a.get('pdf_link')) for a in assessments]
+        self.duration_texts = [_text(a.get('duration')) for a in assessments]
+
+        self.durations = np.array([parse_duration_minutes(t) for t in self.duration_texts], dtype=np.int32)
+        self.remote_testing = np.array(
+            [parse_bool_field(a.get('remote_testing_support')) for a in assessments], dtype=np.int8
+        )
+        self.adaptive_irt = np.array(
+            [parse_bool_field(a.get('adaptive_irt_support')) for a in assessments], dtype=np.int8
+        )
+
+        self.job_levels = CategoricalColumn(parse_list_field(a.get('job_levels')) for a in assessments)
+        self.languages = CategoricalColumn(parse_list_field(a.get('languages')) for a in assessments)
+        self.test_types = CategoricalColumn(parse_list_field(a.get('test_type')) for a in assessments)
+
+        # Per-row scrape metadata is nearly always identical, so store it once per distinct value
+        metadata_code = {}
+        codes = []
+        for a in assessments:
+            key = repr(sorted(parse_dict_field(a.get('metadata')).items()))
+            codes.append(metadata_code.setdefault(key, len(metadata_code)))
+        self._metadata_values = [dict(ast.literal_eval(key)) for key in metadata_code]
+        self.row_metadata = np.array(codes, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def _flag(value):
+        return None if value == UNKNOWN else bool(value)
+
+    def record(self, i):
+        """Plain dict for one assessment, with typed values"""
+        test_types = self.test_types.row(i)
+        return {
+            'name': self.names[i],
+            'url': self.urls[i],
+            'description': self.descriptions[i],
+            'job_levels': self.job_levels.row(i),
+            'languages': self.languages.row(i),
+            'duration': self.duration_texts[i],
+            'remote_testing_support': self._flag(self.remote_testing[i]),
+            'adaptive_irt_support': self._flag(self.adaptive_irt[i]),
+            'pdf_link': self.pdf_links[i],
+            'test_type': test_types[0] if len(test_types) == 1 else test_types,
+            'metadata': dict(self._metadata_values[self.row_metadata[i]]),
+        }
+
+    def records(self):
+        for i in range(len(self)):
+            yield self.record(i)
+
+    def to_dict(self):
+        """The whole catalog in its JSON shape"""
+        return {'metadata': dict(self.metadata), 'assessments': list(self.records())}
+
+    def values(self, field):
+        """Sorted distinct values of 'job_levels', 'languages' or 'test_type'"""
+        column = {'job_levels': self.job_levels, 'languages': self.languages, 'test_type': self.test_types}[field]
+        present = set(column.codes.tolist())
+        return sorted(value for code, value in enumerate(column.categories) if code in present)
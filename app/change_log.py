@@ -0,0 +1,83 @@
+import fcntl
+import json
+import os
+import uuid
+from app.shared_index import flock
+
+
+class ChangeLog:
+    """
+    Append-only log of admin changes, shared by every worker of one catalog
+
+    The log sits next to the catalog as `<catalog>.changes.jsonl`. Its first
+    line names a generation and every other line is one ('upsert', assessment)
+    or ('delete', id) operation. Workers append under an exclusive flock and
+    replay the entries they haven't applied yet, so a change accepted by one
+    worker reaches the others. Compaction merges the log into the catalog and
+    index under the same lock and then starts a new generation, which tells
+    the other workers to reload instead of replaying.
+    """
+
+    def __init__(self, catalog_path):
+        self.path = catalog_path + '.changes.jsonl'
+        self.lock_path = catalog_path + '.changes.lock'
+
+    def locked(self, operation=fcntl.LOCK_EX):
+        """Hold the log's lock: shared to read, exclusive to append, reset or compact"""
+        return flock(self.lock_path, operation)
+
+    def signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self):
+        """
+        The current generation and its operations; call with the lock held
+
+        Returns:
+            (generation, operations), with generation None if there is no log yet
+        """
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return None, []
+
+        generation, operations = None, []
+        for number, line in enumerate(lines, start=1):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Only a crash mid-append leaves a partial line behind
+                print(f"Skipping unreadable line {number} of {self.path}")
+                continue
+            if number == 1:
+                generation = entry['generation']
+            else:
+                operations.append((entry['operation'], entry['value']))
+        return generation, operations
+
+    def append(self, operation):
+        """Add one operation at the end; call with the exclusive lock held"""
+        name, value = operation
+        line = json.dumps({'operation': name, 'value': value}, default=str) + '\n'
+        with open(self.path, 'ab+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset(self):
+        """Start a new, empty generation; call with the exclusive lock held"""
+        generation = uuid.uuid4().hex
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'generation': generation}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + '.tmp', self.path)
+        return generation
@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the recommender already has as many requests as it will queue"""
+
+    def __init__(self, retry_after):
+        super().__init__("Recommender is at capacity, retry later")
+        self.retry_after = retry_after
+
+
+class RecommenderPool:
+    """
+    Size-bounded thread pool for CPU-bound encoding and scoring
+
+    Encoding (PyTorch) and scoring (NumPy) release the GIL, so a small thread
+    pool gives real parallelism while keeping the event loop free. `admit()`
+    caps the number of requests in flight; beyond that callers get a
+    QueueFullError instead of an ever-growing queue.
+    """
+
+    def __init__(self, max_workers=None, max_pending=64, retry_after=1):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="recommender")
+
+    def check_capacity(self):
+        """Fail fast when no more requests can be admitted"""
+        if self.in_flight >= self.max_pending:
+            self.rejected += 1
+            raise QueueFullError(self.retry_after)
+
+    def reserve(self):
+        """
+        Take a slot now or fail fast, returning a callable that gives it back
+
+        For work that outlives the handler, such as a streamed body; calling
+        the release more than once is harmless.
+        """
+        self.check_capacity()
+        self.in_flight += 1
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self.in_flight -= 1
+        return release
+
+    @contextmanager
+    def admit(self):
+        """Reserve a slot for one request or fail fast when saturated"""
+        release = self.reserve()
+        try:
+            yield
+        finally:
+            release()
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking call on the pool without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,212 @@
+import bisect
+import copy
+import hashlib
+import json
+import threading
+import numpy as np
+from app.catalog import Catalog
+from app.facets import FacetIndex
+from app.index_store import assessment_id
+
+# Catalog.values field -> facet holding its values
+_FACET_OF = {'job_levels': 'job_levels', 'languages': 'languages', 'test_type': 'test_types'}
+
+
+def _append(array, n, value):
+    """Write row n, growing the array by doubling; returns the array to keep"""
+    if n == array.shape[0]:
+        grown = np.empty((max(16, 2 * n),) + array.shape[1:], dtype=array.dtype)
+        grown[:n] = array[:n]
+        grown[n] = value
+        return grown
+    array[n] = value
+    return array
+
+
+class _Columns:
+    """
+    Append-only columns shared by the deltas derived from one another
+
+    Every CatalogDelta reads only its own prefix of these lists and arrays,
+    so deriving a delta appends one row instead of copying the ones before
+    it, and rows appended later stay invisible to the deltas older
+    snapshots hold. Appends take `lock`; reads don't need it. A delta that
+    isn't the newest of its lineage appends to a copy of its prefix instead.
+    """
+
+    def __init__(self, dim):
+        # One single-row Catalog per appended assessment, for typed records
+        self.rows = []
+        self.embeddings = np.zeros((0, dim), dtype=np.float32)
+        self.durations = np.zeros(0, dtype=np.int32)
+        # facet -> value -> appended rows (0-based) having it, in order
+        self.facets = {facet: {} for facet in FacetIndex.FACETS}
+        # assessment ID -> rows it was appended at, in order
+        self.rows_of = {}
+        # Tombstoned rows in the order they were tombstoned, and row -> position there
+        self.deleted = []
+        self.deleted_at = {}
+        self.operations = []
+        self.lock = threading.Lock()
+
+    def prefix(self, delta):
+        """Copy of the columns as `delta` sees them"""
+        columns = _Columns(self.embeddings.shape[1])
+        n = len(delta)
+        columns.rows = self.rows[:n]
+        columns.embeddings = self.embeddings[:n].copy()
+        columns.durations = self.durations[:n].copy()
+        for facet, values in self.facets.items():
+            for value, rows in list(values.items()):
+                k = bisect.bisect_left(rows, n)
+                if k:
+                    columns.facets[facet][value] = rows[:k]
+        for id_, rows in list(self.rows_of.items()):
+            k = bisect.bisect_left(rows, delta.size)
+            if k:
+                columns.rows_of[id_] = rows[:k]
+        columns.deleted = self.deleted[:delta.deleted_count]
+        columns.deleted_at = {row: i for i, row in enumerate(columns.deleted)}
+        columns.operations = self.operations[:delta.changes]
+        return columns
+
+
+class CatalogDelta:
+    """
+    Assessments changed since the last compaction, layered over a base snapshot
+
+    Base rows keep their positions. Upserted assessments are appended as rows
+    `base_size`, `base_size + 1`, ... and the rows they replace, like deleted
+    ones, are tombstoned. A delta is never modified: each change derives a
+    new one that appends to the columns it shares with this one, in
+    O(changed items), and the snapshot holding it is swapped in whole.
+    `operations` records the changes so they can be replayed on a reload.
+    """
+
+    def __init__(self, base_size, dim, metadata=None):
+        self.base_size = base_size
+        self.metadata = metadata or {}
+        self._columns = _Columns(dim)
+        self._appended = 0
+        self.deleted_count = 0
+        self.changes = 0
+        # Chained hash of the operations, so equal deltas get equal versions
+        self.digest = ''
+        self._deleted = None
+
+    def __len__(self):
+        return self._appended
+
+    @property
+    def size(self):
+        """Rows in the base plus appended rows, including tombstoned ones"""
+        return self.base_size + self._appended
+
+    @property
+    def live_size(self):
+        """Assessments currently served: all rows minus tombstoned ones"""
+        return self.size - self.deleted_count
+
+    @property
+    def operations(self):
+        return tuple(self._columns.operations[:self.changes])
+
+    @property
+    def embeddings(self):
+        """Embeddings of the appended rows"""
+        return self._columns.embeddings[:self._appended]
+
+    @property
+    def deleted(self):
+        """Tombstoned rows as an array, computed on first use"""
+        if self._deleted is None:
+            self._deleted = np.array(sorted(self._columns.deleted[:self.deleted_count]), dtype=np.int64)
+        return self._deleted
+
+    def is_deleted(self, row):
+        return self._columns.deleted_at.get(row, self.deleted_count) < self.deleted_count
+
+    def record(self, j):
+        """Plain dict for appended row j"""
+        return self._columns.rows[j].record(0)
+
+    def row_of(self, id_):
+        """Live appended row of an assessment ID, or None"""
+        rows = self._columns.rows_of.get(id_, ())
+        k = bisect.bisect_left(rows, self.size)
+        if k and not self.is_deleted(rows[k - 1]):
+            return rows[k - 1]
+        return None
+
+    def values(self, field):
+        """Distinct values of 'job_levels', 'languages' or 'test_type' among appended rows"""
+        values = self._columns.facets[_FACET_OF[field]]
+        return {value for value, rows in list(values.items()) if rows[0] < self._appended}
+
+    def _value_mask(self, facet, value):
+        mask = np.zeros(self._appended, dtype=bool)
+        rows = self._columns.facets[facet].get(value, [])
+        mask[rows[:bisect.bisect_left(rows, self._appended)]] = True
+        return mask
+
+    def mask(self, job_level=None, duration_max=None, languages=None, test_type=None):
+        """Mask of appended rows that pass the given filters, as FacetIndex.mask"""
+        mask = np.ones(self._appended, dtype=bool)
+        if job_level:
+            mask &= self._value_mask('job_levels', job_level)
+        if duration_max is not None:
+            mask &= self._columns.durations[:self._appended] <= duration_max
+        if languages:
+            any_language = np.zeros(self._appended, dtype=bool)
+            for lang in languages:
+                any_language |= self._value_mask('languages', lang)
+            mask &= any_language
+        if test_type:
+            mask &= self._value_mask('test_types', test_type)
+        return mask
+
+    def _derive(self, operation, append):
+        """New delta with `append(columns)` applied past this delta's prefix"""
+        with self._columns.lock:
+            columns = self._columns
+            if len(columns.operations) != self.changes:
+                # A newer delta already appended to the shared columns
+                columns = columns.prefix(self)
+            delta = copy.copy(self)
+            delta._columns = columns
+            delta._deleted = None
+            append(delta, columns)
+            columns.operations.append(operation)
+            delta.changes += 1
+
+        blob = self.digest + json.dumps(operation, sort_keys=True, default=str)
+        delta.digest = hashlib.sha256(blob.encode('utf-8')).hexdigest()
+        return delta
+
+    def _tombstone(self, columns, row):
+        columns.deleted_at[row] = len(columns.deleted)
+        columns.deleted.append(row)
+        self.deleted_count += 1
+
+    def upsert(self, assessment, embedding, replaced_row=None):
+        """New delta with the assessment appended and the row it replaces tombstoned"""
+        row = Catalog({'metadata': self.metadata, 'assessments': [assessment]})
+
+        def append(delta, columns):
+            j = delta._appended
+            columns.rows.append(row)
+            columns.embeddings = _append(columns.embeddings, j, np.asarray(embedding, dtype=np.float32))
+            columns.durations = _append(columns.durations, j, row.durations[0])
+            for facet in FacetIndex.FACETS:
+                for value in getattr(row, facet).row(0):
+                    columns.facets[facet].setdefault(value, []).append(j)
+            columns.rows_of.setdefault(assessment_id(assessment), []).append(delta.base_size + j)
+            if replaced_row is not None:
+                delta._tombstone(columns, replaced_row)
+            delta._appended += 1
+
+        return self._derive(('upsert', assessment), append)
+
+    def delete(self, row, id_):
+        """New delta with one row tombstoned"""
+        return self._derive(('delete', id_), lambda delta, columns: delta._tombstone(columns, row))
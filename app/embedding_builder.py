@@ -0,0 +1,61 @@
+import hashlib
+import numpy as np
+from app.index_store import assessment_id, normalize_rows
+
+
+def embedding_text(assessment):
+    """Text that gets embedded for an assessment"""
+    return f"{assessment.get('name', '')} {assessment.get('description', '')}"
+
+
+def content_hash(text):
+    """Hash of the embedded text, used to detect rows that need re-encoding"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingBuilder:
+    def __init__(self, model, batch_size=32):
+        self.model = model
+        self.batch_size = batch_size
+
+    def build(self, assessments, previous_matrix=None, previous_manifest=None):
+        """
+        Build the embedding matrix for a catalog, reusing unchanged rows
+
+        Args:
+            assessments: Catalog assessments in row order
+            previous_matrix: Embedding matrix of the last build, if any
+            previous_manifest: Manifest of the last build, if any
+
+        Returns:
+            (matrix, ids, hashes, stats) where stats counts reused and encoded rows
+        """
+        ids = [assessment_id(a) for a in assessments]
+        texts = [embedding_text(a) for a in assessments]
+        hashes = [content_hash(t) for t in texts]
+        dim = self.model.get_sentence_embedding_dimension()
+
+        # Rows from the previous build whose text hash is unchanged
+        previous = {}
+        if previous_matrix is not None and previous_manifest is not None:
+            previous_hashes = previous_manifest.get('hashes') or []
+            for row, (id_, hash_) in enumerate(zip(previous_manifest.get('ids', []), previous_hashes)):
+                previous[id_] = (row, hash_)
+
+        matrix = np.zeros((len(assessments), dim), dtype=np.float32)
+        stale = []
+        for i, (id_, hash_) in enumerate(zip(ids, hashes)):
+            row, old_hash = previous.get(id_, (None, None))
+            if old_hash == hash_ and previous_matrix.shape[1] == dim:
+                matrix[i] = previous_matrix[row]
+            else:
+                stale.append(i)
+
+        # Only new or edited rows go through the model, in batches
+        for start in range(0, len(stale), self.batch_size):
+            batch = stale[start:start + self.batch_size]
+            vectors = self.model.encode([texts[i] for i in batch], batch_size=self.batch_size)
+            matrix[batch] = normalize_rows(vectors)
+
+        stats = {'reused': len(assessments) - len(stale), 'encoded': len(stale)}
+        return matrix, ids, hashes, stats
@@ -0,0 +1,119 @@
+"""
+Query and catalog encoders behind one interface
+
+Every backend exposes the subset of the SentenceTransformer API the
+recommender and index builder use: `encode(texts, batch_size)`,
+`get_sentence_embedding_dimension()`, `max_seq_length` and `tokenizer`.
+`index_name` identifies the embedding space, so an index built by one
+backend is only served with a compatible one.
+"""
+import hashlib
+import os
+import numpy as np
+
+ENCODER_BACKEND = 'sentence-transformers'
+ONNX_CACHE_DIR = 'data/models'
+
+
+class SentenceTransformerEncoder:
+    """The default PyTorch sentence-transformers model"""
+
+    def __init__(self, model_name, **model_kwargs):
+        from sentence_transformers import SentenceTransformer
+        self.index_name = model_name
+        self.model = SentenceTransformer(model_name, **model_kwargs)
+
+    @property
+    def max_seq_length(self):
+        return self.model.max_seq_length
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    def get_sentence_embedding_dimension(self):
+        return self.model.get_sentence_embedding_dimension()
+
+    def encode(self, texts, batch_size=32):
+        return np.asarray(self.model.encode(texts, batch_size=batch_size), dtype=np.float32)
+
+
+class OnnxEncoder(SentenceTransformerEncoder):
+    """
+    The same model exported to ONNX and run on ONNX Runtime's CPU provider
+
+    With `quantize=True` the weights are dynamically quantized to int8 for
+    the given instruction set ('avx2', 'avx512', 'avx512_vnni' or 'arm64').
+    The quantized export is cached under `cache_dir` so it is only produced
+    once per node. Needs `optimum[onnxruntime]`.
+    """
+
+    def __init__(self, model_name, quantize=False, quantization_config='avx2', cache_dir=ONNX_CACHE_DIR):
+        try:
+            from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+        except ImportError as e:
+            raise ImportError("The ONNX encoder needs `pip install optimum[onnxruntime]`") from e
+
+        # Quantized vectors stay in the float model's embedding space
+        self.index_name = model_name
+        if not quantize:
+            self.model = SentenceTransformer(model_name, backend='onnx', device='cpu')
+            return
+
+        local_dir = os.path.join(cache_dir, model_name.replace('/', '__'))
+        file_name = f"onnx/model_qint8_{quantization_config}.onnx"
+        if not os.path.exists(os.path.join(local_dir, file_name)):
+            print(f"Exporting {model_name} to int8 ONNX ({quantization_config}) in {local_dir}...")
+            model = SentenceTransformer(model_name, backend='onnx', device='cpu')
+            model.save(local_dir)
+            export_dynamic_quantized_onnx_model(model, quantization_config, local_dir)
+        self.model = SentenceTransformer(local_dir, backend='onnx', device='cpu',
+                                         model_kwargs={'file_name': file_name})
+
+
+class HashEncoder:
+    """
+    Deterministic bag-of-words hashing encoder for tests and local runs
+
+    Each lower-cased word adds a signed count to one of `dim` buckets. It
+    needs no model download and has no semantic knowledge at all.
+    """
+
+    tokenizer = None
+
+    def __init__(self, model_name=None, dim=384, max_seq_length=256):
+        self.dim = dim
+        self.max_seq_length = max_seq_length
+        self.index_name = f"hash-{dim}"
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+    def _encode_one(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            digest = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        return vector
+
+    def encode(self, texts, batch_size=32):
+        if isinstance(texts, str):
+            return self._encode_one(texts)
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.stack([self._encode_one(text) for text in texts])
+
+
+ENCODER_BACKENDS = {
+    'sentence-transformers': SentenceTransformerEncoder,
+    'onnx': OnnxEncoder,
+    'onnx-int8': lambda model_name, **options: OnnxEncoder(model_name, quantize=True, **options),
+    'hash': HashEncoder,
+}
+
+
+def make_encoder(backend=ENCODER_BACKEND, model_name=None, **options):
+    """Create an encoder by backend name (see ENCODER_BACKENDS)"""
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}; choose from {sorted(ENCODER_BACKENDS)}")
+    return ENCODER_BACKENDS[backend](model_name, **options)
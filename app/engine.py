@@ -0,0 +1,336 @@
+import asyncio
+import contextlib
+import fcntl
+import os
+import threading
+import time
+import traceback
+from app.change_log import ChangeLog
+from app.recommender import SHLRecommender
+
+
+class RecommenderEngine:
+    """
+    Owns the per-worker recommender and tracks whether it is ready to serve
+
+    Each SHLRecommender is an immutable catalog + index snapshot. `reload`
+    builds a new one beside the serving one and swaps a single reference,
+    so requests that already hold the old snapshot finish on it and no
+    request ever sees a half-loaded catalog. With `poll_seconds` set, a
+    watcher thread reloads when the catalog or index manifest changes.
+
+    Admin changes go through `update`, which records them in the catalog's
+    shared ChangeLog and swaps in the derived snapshot the same way. Every
+    update, reload and poll first applies what other workers appended, and
+    compaction merges the log under its lock. Within one worker, reloads,
+    updates and compactions are serialized by one lock; across workers,
+    by the log's flock. With `change_log` off, or when the catalog's
+    directory is read-only, the engine serves without a log and rejects
+    updates.
+    """
+
+    LOADING = "loading"
+    READY = "ready"
+    FAILED = "failed"
+
+    def __init__(self, factory=SHLRecommender, poll_seconds=0, compact_seconds=0, change_log=True,
+                 load_retries=0, retry_seconds=2.0, max_retry_seconds=60.0):
+        self.factory = factory
+        self.load_retries = load_retries
+        self.retry_seconds = retry_seconds
+        self.max_retry_seconds = max_retry_seconds
+        self.load_attempts = 0
+        self.retrying = False
+        self.poll_seconds = poll_seconds
+        self.compact_seconds = compact_seconds
+        self.change_log = change_log
+        self.log = None
+        self.recommender = None
+        self.status = self.LOADING
+        self.error = None
+        self.timings = {}
+        self.reloads = 0
+        self.reload_error = None
+        self._task = None
+        self._write_lock = threading.Lock()
+        self._disk_signature = None
+        # Log generation and number of its operations the serving snapshot includes
+        self._generation = None
+        self._applied = 0
+        self._log_signature = None
+        self._stopped = threading.Event()
+
+    @property
+    def ready(self):
+        return self.status == self.READY
+
+    @property
+    def version(self):
+        """Version of the snapshot being served, or None before the first load"""
+        recommender = self.recommender
+        return recommender.version if recommender is not None else None
+
+    @property
+    def reloading(self):
+        """True while a reload, update or compaction holds the write lock"""
+        return self._write_lock.locked()
+
+    def load(self):
+        """
+        Build the recommender and warm it up (blocking)
+
+        A failed load is retried up to `load_retries` times, waiting
+        `retry_seconds` and doubling up to `max_retry_seconds`, so e.g. an
+        index that is still being built is picked up. The status stays
+        FAILED between attempts; `retrying` turns False once the engine
+        gives up.
+        """
+        delay = self.retry_seconds
+        while not self._stopped.is_set():
+            self.load_attempts += 1
+            self.retrying = self.load_attempts <= self.load_retries
+            if self._load():
+                return
+            if not self.retrying:
+                return
+            print(f"Load attempt {self.load_attempts} failed; retrying in {delay:.1f}s")
+            self._stopped.wait(delay)
+            delay = min(delay * 2, self.max_retry_seconds)
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            recommender = self.factory()
+            self._disk_signature = self._signature(recommender)
+            recommender, position = self._open_log(recommender)
+            recommender.warm_up()
+        except Exception as e:
+            self.status = self.FAILED
+            self.error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+            return False
+
+        self.timings = dict(recommender.load_timings)
+        self.timings['total_seconds'] = time.perf_counter() - start
+        self.recommender = recommender
+        self._generation, self._applied, self._log_signature = position
+        self.status = self.READY
+        self.error = None
+        self.retrying = False
+        print(f"Recommender ready in {self.timings['total_seconds']:.2f}s "
+              f"(snapshot {recommender.version})")
+
+        if self.poll_seconds and not self._stopped.is_set():
+            threading.Thread(target=self._watch, name="catalog-watcher", daemon=True).start()
+        if self.compact_seconds and self.log is not None and not self._stopped.is_set():
+            threading.Thread(target=self._compact_periodically, name="catalog-compaction", daemon=True).start()
+        return True
+
+    def reload(self):
+        """
+        Load a fresh snapshot and swap it in (blocking)
+
+        Returns:
+            True once the new snapshot serves, False if a reload or update is
+            already running or loading failed (the old snapshot keeps serving)
+        """
+        if not self.ready or not self._write_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._locked(fcntl.LOCK_SH):
+                return self._reload()
+        finally:
+            self._write_lock.release()
+
+    def sync(self):
+        """
+        Apply the changes other workers appended to the log (blocking)
+
+        Returns:
+            False if a reload or update is already running or catching up failed
+        """
+        if not self.ready or not self._write_lock.acquire(blocking=False):
+            return False
+        try:
+            with self._locked(fcntl.LOCK_SH):
+                return self._catch_up()
+        finally:
+            self._write_lock.release()
+
+    def _open_log(self, recommender):
+        """Open the catalog's change log and replay it, or go without one if it can't be written"""
+        if self.change_log:
+            self.log = ChangeLog(recommender.catalog_path)
+            try:
+                with self.log.locked(fcntl.LOCK_SH):
+                    return self._from_log(recommender)
+            except OSError as e:
+                print(f"No shared change log ({e}); serving the catalog without admin changes")
+                self.log = None
+        return recommender, (None, 0, None)
+
+    def _locked(self, operation=fcntl.LOCK_EX):
+        return self.log.locked(operation) if self.log is not None else contextlib.nullcontext()
+
+    def _from_log(self, recommender):
+        """A snapshot fresh from disk with the whole log replayed; call with the log locked"""
+        if self.log is None:
+            return recommender, (None, 0, None)
+        signature = self.log.signature()
+        generation, operations = self.log.read()
+        if operations:
+            print(f"Replaying {len(operations)} uncompacted changes on the new snapshot")
+            recommender = recommender.replay(operations)
+        return recommender, (generation, len(operations), signature)
+
+    def _catch_up(self):
+        """Apply new log entries, or reload if the log was compacted meanwhile; call with it locked"""
+        if self.log is None:
+            return True
+        signature = self.log.signature()
+        generation, operations = self.log.read()
+        if generation != self._generation:
+            return self._reload()
+        if len(operations) > self._applied:
+            self.recommender = self.recommender.replay(operations[self._applied:])
+            self._applied = len(operations)
+        self._log_signature = signature
+        return True
+
+    def _reload(self, **options):
+        current = self.recommender
+        start = time.perf_counter()
+        try:
+            # The encoder, query embeddings and shard workers don't depend on the catalog
+            self._disk_signature = self._signature(current)
+            recommender = self.factory(encoder=current.encoder, shard_pool=current.shard_pool, **options)
+            recommender.query_cache = current.query_cache
+            recommender, position = self._from_log(recommender)
+            recommender.warm_up()
+        except Exception as e:
+            self.reload_error = f"{type(e).__name__}: {e}"
+            traceback.print_exc()
+            return False
+
+        self.recommender = recommender
+        self._generation, self._applied, self._log_signature = position
+        self.reload_error = None
+        self.reloads += 1
+        self.timings['reload_seconds'] = time.perf_counter() - start
+        print(f"Swapped snapshot {current.version} for {recommender.version} "
+              f"in {self.timings['reload_seconds']:.2f}s")
+        return True
+
+    def update(self, operation):
+        """
+        Apply an admin change, append it to the log and swap in the result (blocking)
+
+        Args:
+            operation: ('upsert', assessment) or ('delete', id)
+
+        Returns:
+            The new snapshot
+
+        Raises:
+            KeyError: The assessment to delete isn't there
+            ValueError: The assessment has neither a url nor a name
+            RuntimeError: There is no change log, or changes made by other
+                workers could not be applied
+        """
+        if self.log is None:
+            raise RuntimeError("Admin changes need a change log in a writable catalog directory")
+        with self._write_lock, self.log.locked():
+            if not self._catch_up():
+                raise RuntimeError(f"Could not apply the shared change log: {self.reload_error}")
+            name, value = operation
+            if name == 'upsert':
+                recommender = self.recommender.upsert(value)
+            else:
+                recommender = self.recommender.delete(value)
+            if self._generation is None:
+                self._generation = self.log.reset()
+            self.log.append(operation)
+            self._applied += 1
+            self._log_signature = self.log.signature()
+            self.recommender = recommender
+            return recommender
+
+    def compact(self):
+        """Merge the change log into fresh artifacts and reload from them (blocking)"""
+        if self.log is None:
+            return True
+        with self._write_lock, self.log.locked():
+            if not self._catch_up():
+                return False
+            if not self._applied:
+                return True
+            start = time.perf_counter()
+            if self.recommender.delta.changes:
+                self.recommender.compact()
+            self.log.reset()
+            self.timings['compact_seconds'] = time.perf_counter() - start
+            # The files were just written and checksummed here; skip hashing them again
+            return self._reload(verify_index=False)
+
+    def _compact_periodically(self):
+        """Compact every `compact_seconds` while changes are pending"""
+        while not self._stopped.wait(self.compact_seconds):
+            if self.recommender is None:
+                continue
+            with self.log.locked(fcntl.LOCK_SH):
+                _, operations = self.log.read()
+            if operations:
+                print(f"Compacting {len(operations)} logged catalog changes...")
+                self.compact()
+
+    @staticmethod
+    def _signature(recommender):
+        signature = []
+        for path in (recommender.catalog_path, recommender.manifest_path):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _watch(self):
+        """Poll the catalog and manifest mtimes (reloading once they settle) and the change log"""
+        pending = None
+        while not self._stopped.wait(self.poll_seconds):
+            recommender = self.recommender
+            if recommender is None:
+                continue
+            # Reloads and compactions record what they read, so their own writes are skipped
+            current = self._signature(recommender)
+            if current == self._disk_signature:
+                pending = None
+                # Changes other workers logged; a failed catch-up waits for the next one
+                log_signature = self.log.signature() if self.log is not None else None
+                if log_signature != self._log_signature and not self.sync() and not self.reloading:
+                    self._log_signature = log_signature
+                continue
+            # Wait one quiet interval so a file still being written isn't read
+            if current != pending:
+                pending = current
+                continue
+            print("Catalog or index changed on disk, reloading...")
+            pending = None
+            if not self.reload() and not self.reloading:
+                # Don't retry a failed reload until the files change again
+                self._disk_signature = current
+
+    def encode_queries(self, queries):
+        return self.recommender.encode_queries(queries)
+
+    def start(self):
+        """Load in a worker thread so the event loop keeps answering probes"""
+        self._task = asyncio.create_task(asyncio.to_thread(self.load))
+        return self._task
+
+    def stop(self):
+        # A load still running in its thread is simply abandoned
+        self._stopped.set()
+        if self.recommender is not None and self.recommender.shard_pool is not None:
+            self.recommender.shard_pool.shutdown()
+        self.recommender = None
@@ -56,8 +56,7 @@ class RecommenderBenchmark:
             rec_names = [r["assessment"]["name"] for r in recommendations]
             
             # Build catalog assessment list and binary relevance vector
-            catalog_data = self.recommender.catalog_data
-            all_assessments = [a["name"] for a in catalog_data["assessments"]]
+            all_assessments = self.recommender.catalog.names
             relevance = [1 if name in query_data["relevant_assessments"] else 0 for name in all_assessments]
             
             # Map recommendations to indices
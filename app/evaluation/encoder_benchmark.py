@@ -0,0 +1,101 @@
+"""
+Latency, throughput and memory of the encoder backends on this machine
+
+Usage:
+    python -m app.evaluation.encoder_benchmark [--backends NAME ...] [--queries N] [--batch-size N]
+
+Each backend runs in its own process so its resident memory is measured in
+isolation. Texts are catalog names and descriptions; agreement is the mean
+cosine similarity with the first backend's embeddings of the same texts.
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from app.build_index import CATALOG_PATH
+from app.catalog import Catalog
+from app.embedding_builder import embedding_text
+from app.encoders import make_encoder
+from app.index_store import MODEL_NAME, normalize_rows
+
+
+def rss_mb():
+    """Current resident set size of this process in MiB"""
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Peak rather than current RSS, in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_texts(catalog_path=CATALOG_PATH, n_texts=256):
+    with open(catalog_path, 'r', encoding='utf-8') as f:
+        texts = [embedding_text(a) for a in Catalog(json.load(f)).records()]
+    return [texts[i % len(texts)] for i in range(n_texts)]
+
+
+def benchmark_backend(backend, model_name, texts, batch_size=32):
+    """Load one backend and time single-query and batched encoding"""
+    baseline_rss = rss_mb()
+    start = time.perf_counter()
+    encoder = make_encoder(backend, model_name)
+    load_seconds = time.perf_counter() - start
+    encoder.encode(texts[:1])
+
+    # One query at a time, as /recommend sees them without micro-batching
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        encoder.encode([text])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    embeddings = encoder.encode(texts, batch_size=batch_size)
+    batch_seconds = time.perf_counter() - start
+
+    return {
+        'backend': backend,
+        'load_seconds': load_seconds,
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'throughput_per_second': len(texts) / batch_seconds,
+        'rss_mb': rss_mb(),
+        'rss_model_mb': rss_mb() - baseline_rss,
+        'embeddings': normalize_rows(embeddings),
+    }
+
+
+def run_benchmark(backends=('sentence-transformers', 'onnx', 'onnx-int8'), model_name=MODEL_NAME,
+                  n_texts=256, batch_size=32):
+    texts = load_texts(n_texts=n_texts)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(benchmark_backend, backend, model_name, texts, batch_size).result())
+
+    reference = results[0]['embeddings']
+    for result in results:
+        embeddings = result.pop('embeddings')
+        agreement = None
+        if embeddings.shape == reference.shape:
+            agreement = float(np.mean(np.sum(embeddings * reference, axis=1)))
+        result['agreement_with_' + backends[0]] = agreement
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark encoder backends")
+    parser.add_argument('--backends', nargs='+', default=['sentence-transformers', 'onnx', 'onnx-int8'])
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--queries', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.backends, args.model, args.queries, args.batch_size), indent=2))
@@ -0,0 +1,73 @@
+"""
+Recall and latency of int8 first-pass scoring against the float32 baseline
+
+Usage:
+    python -m app.evaluation.quantization_benchmark [--manifest PATH] [--queries N] [--k K]
+
+Queries are catalog embeddings with Gaussian noise added, so no model is
+needed and the benchmark runs against any built index.
+"""
+import argparse
+import json
+import time
+import numpy as np
+from app.ann import top_k
+from app.index_store import MANIFEST_PATH, load_index, normalize_rows
+from app.quantization import Int8Embeddings
+
+
+def make_queries(matrix, n_queries, noise=0.05, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(matrix.shape[0], size=n_queries, replace=matrix.shape[0] < n_queries)
+    queries = np.asarray(matrix[rows], dtype=np.float32)
+    return normalize_rows(queries + rng.normal(0, noise, queries.shape).astype(np.float32))
+
+
+def run_benchmark(manifest_path=MANIFEST_PATH, n_queries=200, k=10, rerank_factors=(1, 2, 4, 8)):
+    """Recall@k and mean latency per query for float32, int8 only and int8 + re-ranking"""
+    matrix, _ = load_index(manifest_path)
+    matrix = np.ascontiguousarray(matrix)
+    quantized = Int8Embeddings.from_matrix(matrix)
+    queries = make_queries(matrix, n_queries)
+    k = min(k, matrix.shape[0])
+
+    def timed(search):
+        results, start = [], time.perf_counter()
+        for query in queries:
+            results.append(set(search(query).tolist()))
+        return results, (time.perf_counter() - start) / len(queries) * 1000
+
+    baseline, baseline_ms = timed(lambda q: top_k(matrix @ q, k))
+    modes = {'float32': (baseline, baseline_ms)}
+    modes['int8'] = timed(lambda q: top_k(quantized.scores(q), k))
+    for factor in rerank_factors:
+        def search(q, factor=factor):
+            candidates = top_k(quantized.scores(q), k * factor)
+            return candidates[top_k(matrix[candidates] @ q, k)]
+        modes[f'int8+rerank x{factor}'] = timed(search)
+
+    return {
+        'items': int(matrix.shape[0]),
+        'dim': int(matrix.shape[1]),
+        'k': k,
+        'bytes_per_item': {
+            'float32': matrix.nbytes / matrix.shape[0],
+            'int8': quantized.nbytes / matrix.shape[0],
+        },
+        'modes': {
+            name: {
+                'recall_at_k': float(np.mean([len(r & b) / k for r, b in zip(results, baseline)])),
+                'ms_per_query': ms,
+            }
+            for name, (results, ms) in modes.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark int8 embedding scoring")
+    parser.add_argument('--manifest', default=MANIFEST_PATH)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.manifest, args.queries, args.k), indent=2))
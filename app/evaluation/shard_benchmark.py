@@ -0,0 +1,104 @@
+"""
+Latency of sharded scatter-gather search against a single process
+
+Usage:
+    python -m app.evaluation.shard_benchmark [--rows N] [--dim D] [--processes P ...] [--queries N] [--k K]
+
+A random unit-length matrix of the given size is written to a temporary
+.npy file, so catalog sizes well beyond the real one can be tried without
+a model. Each pool size is timed on single queries (the /recommend path)
+and on one batch (the /recommend/batch path); recall is measured against
+the single-process top-k and should be 1.0, since sharding is exact.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from app.ann import top_k
+from app.index_store import normalize_rows
+from app.shards import ShardPool
+
+
+def write_matrix(path, n_rows, dim, seed=0, chunk_size=65536):
+    """Random unit-length rows written in chunks, so the matrix never sits in RAM whole"""
+    rng = np.random.default_rng(seed)
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n_rows, dim))
+    for start in range(0, n_rows, chunk_size):
+        end = min(n_rows, start + chunk_size)
+        matrix[start:end] = normalize_rows(rng.standard_normal((end - start, dim), dtype=np.float32))
+    matrix.flush()
+    del matrix
+
+
+def timed(search, queries):
+    """Per-query latencies in ms and the results"""
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies, results
+
+
+def summary(latencies, results, baseline, k):
+    return {
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'recall_at_k': float(np.mean([len(set(r.tolist()) & set(b.tolist())) / k
+                                      for r, b in zip(results, baseline)])),
+    }
+
+
+def run_benchmark(n_rows=1000000, dim=384, processes=None, n_queries=50, k=10, batch_size=32):
+    processes = processes or sorted({1, 2, 4, os.cpu_count() or 1})
+    directory = tempfile.mkdtemp(prefix='shard_benchmark-')
+    try:
+        path = os.path.join(directory, 'embeddings.npy')
+        write_matrix(path, n_rows, dim)
+        matrix = np.load(path, mmap_mode='r')
+        rng = np.random.default_rng(1)
+        queries = normalize_rows(rng.standard_normal((n_queries, dim), dtype=np.float32))
+        k = min(k, n_rows)
+
+        # Single process scoring straight off the memmap, as SHLRecommender does unsharded
+        matrix @ queries[0]
+        latencies, baseline = timed(lambda q: top_k(matrix @ q, k), queries)
+        results = {'rows': n_rows, 'dim': dim, 'k': k, 'cpu_count': os.cpu_count(),
+                   'single_process': summary(latencies, baseline, baseline, k)}
+        reference = results['single_process']['latency_ms_p50']
+
+        for count in processes:
+            pool = ShardPool(count)
+            try:
+                pool.warm(path, n_rows)
+                pool.search(path, n_rows, queries[:1], k)
+                latencies, found = timed(lambda q: pool.search(path, n_rows, q[None, :], k)[0][0], queries)
+                result = summary(latencies, found, baseline, k)
+                result['speedup_p50'] = reference / result['latency_ms_p50']
+
+                start = time.perf_counter()
+                for first in range(0, n_queries, batch_size):
+                    pool.search(path, n_rows, queries[first:first + batch_size], k)
+                result['batch_queries_per_second'] = n_queries / (time.perf_counter() - start)
+                results[f'{count}_processes'] = result
+            finally:
+                pool.shutdown()
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark sharded scatter-gather search")
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--dim', type=int, default=384)
+    parser.add_argument('--processes', type=int, nargs='+')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=32)
+    args = parser.parse_args()
+    print(json.dumps(run_benchmark(args.rows, args.dim, args.processes, args.queries, args.k,
+                                   args.batch_size), indent=2))
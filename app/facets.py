@@ -0,0 +1,66 @@
+import numpy as np
+
+
+class FacetIndex:
+    """
+    Filter columns precompiled once per catalog
+
+    Job levels, languages and test types become one boolean mask per value and
+    durations an int32 column, so any filter combination is a handful of
+    vectorized AND/OR operations instead of a Python loop over assessments.
+    """
+
+    FACETS = ('job_levels', 'languages', 'test_types')
+
+    def __init__(self, catalog):
+        self.size = len(catalog)
+        self.job_levels = catalog.job_levels.masks()
+        self.languages = catalog.languages.masks()
+        self.test_types = catalog.test_types.masks()
+        self.durations = catalog.durations
+
+    def _lookup(self, masks, value):
+        mask = masks.get(value)
+        return mask if mask is not None else np.zeros(self.size, dtype=bool)
+
+    def mask(self, job_level=None, duration_max=None, languages=None, test_type=None):
+        """Row mask of assessments that pass the given filters"""
+        mask = np.ones(self.size, dtype=bool)
+
+        if job_level:
+            mask &= self._lookup(self.job_levels, job_level)
+
+        if duration_max is not None:
+            mask &= self.durations <= duration_max
+
+        if languages:
+            any_language = np.zeros(self.size, dtype=bool)
+            for lang in languages:
+                any_language |= self._lookup(self.languages, lang)
+            mask &= any_language
+
+        if test_type:
+            mask &= self._lookup(self.test_types, test_type)
+
+        return mask
+
+    def to_arrays(self):
+        """Flat arrays (value names plus one stacked mask matrix per facet) for sharing"""
+        arrays = {'facet_durations': self.durations}
+        for facet in self.FACETS:
+            masks = getattr(self, facet)
+            arrays[f'facet_{facet}_values'] = np.array(list(masks), dtype=str)
+            arrays[f'facet_{facet}_masks'] = (np.stack(list(masks.values())) if masks
+                                              else np.zeros((0, self.size), dtype=bool))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Rebuild from `to_arrays` output; the masks stay views into the given arrays"""
+        index = cls.__new__(cls)
+        index.durations = arrays['facet_durations']
+        index.size = index.durations.size
+        for facet in cls.FACETS:
+            values, masks = arrays[f'facet_{facet}_values'], arrays[f'facet_{facet}_masks']
+            setattr(index, facet, {str(value): masks[i] for i, value in enumerate(values)})
+        return index
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+from datetime import datetime
+import numpy as np
+from app.ann import IVFIndex
+from app.lexical import BM25Index
+from app.quantization import Int8Embeddings
+
+# Manifest describing the current embedding index; the embedding matrix
+# itself lives in a versioned .npy file next to it
+MANIFEST_PATH = 'data/processed/shl_embeddings_manifest.json'
+MODEL_NAME = 'all-MiniLM-L6-v2'
+FORMAT_VERSION = 2
+# Manifest fields naming the version-specific files an index consists of
+ARTIFACT_FIELDS = ('embeddings_file', 'ann_file', 'int8_file', 'int8_scales_file', 'lexical_files')
+
+
+class IndexArtifactError(RuntimeError):
+    """The embedding index is missing, corrupt or does not match the catalog"""
+
+
+def assessment_id(assessment):
+    """Stable identifier used to line up catalog rows with embedding rows"""
+    return assessment.get('url') or assessment.get('name', '')
+
+
+def normalize_rows(matrix):
+    """Return a float32 copy of the matrix with unit-length rows"""
+    matrix = np.array(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def file_checksum(path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def index_version(model_name, ids, hashes):
+    """Version string derived from the model and the embedded content"""
+    digest = hashlib.sha256(model_name.encode('utf-8'))
+    for id_, hash_ in zip(ids, hashes):
+        digest.update(f"\n{id_}\t{hash_}".encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def embeddings_path_for(manifest_path, version):
+    """Location of the .npy file for a given index version"""
+    base = os.path.join(os.path.dirname(manifest_path), 'shl_embeddings')
+    return f"{base}-{version}.npy"
+
+
+def ann_path_for(manifest_path, version):
+    """Location of the ANN index file for a given index version"""
+    base = os.path.join(os.path.dirname(manifest_path), 'shl_ann')
+    return f"{base}-{version}.npz"
+
+
+def int8_paths_for(manifest_path, version):
+    """Locations of the int8 codes and their per-row scales for a given index version"""
+    base = os.path.join(os.path.dirname(manifest_path), 'shl_int8')
+    return f"{base}-{version}.npy", f"{base}_scales-{version}.npy"
+
+
+def lexical_path_for(manifest_path, version, name):
+    """Location of one stored BM25 array (e.g. 'lexical_offsets') for a given index version"""
+    base = os.path.join(os.path.dirname(manifest_path), 'shl')
+    return f"{base}_{name}-{version}.npy"
+
+
+def files_checksum(paths):
+    """SHA-256 over the checksums of several files, in the given order"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(file_checksum(path).encode('ascii'))
+    return digest.hexdigest()
+
+
+def artifact_files(manifest):
+    """Names of the files a manifest's index consists of"""
+    files = set()
+    for field in ARTIFACT_FIELDS:
+        value = manifest.get(field)
+        if isinstance(value, dict):
+            files.update(value.values())
+        elif value:
+            files.add(value)
+    return files
+
+
+def _prune(manifest, previous, directory):
+    """
+    Delete the files of the version before `previous`
+
+    Only files this manifest's own history lists are removed, so indexes
+    described by other manifests in the same directory are never touched.
+    """
+    stale = set(previous.get('previous_files') or []) - artifact_files(manifest) - artifact_files(previous)
+    for name in stale:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+def save_index(matrix, ids, hashes, model_name=MODEL_NAME, manifest_path=MANIFEST_PATH, ann=None,
+               lexical=None):
+    """
+    Write a versioned, checksummed embedding index
+
+    The .npy file (and the optional IVF ANN index and BM25 postings of
+    `lexical`, whose documents are the rows of `matrix`) are written under
+    version-specific names first and the manifest is swapped in last, so
+    readers either see the old index or the complete new one.
+    """
+    matrix = normalize_rows(matrix)
+    if matrix.ndim != 2 or matrix.shape[0] != len(ids) or len(ids) != len(hashes):
+        raise ValueError(f"Got {matrix.shape[0]} embeddings for {len(ids)} ids and {len(hashes)} hashes")
+
+    version = index_version(model_name, ids, hashes)
+    embeddings_path = embeddings_path_for(manifest_path, version)
+    os.makedirs(os.path.dirname(embeddings_path) or '.', exist_ok=True)
+    with open(embeddings_path + '.tmp', 'wb') as f:
+        np.save(f, matrix)
+    os.replace(embeddings_path + '.tmp', embeddings_path)
+
+    ann_file = None
+    if ann is not None:
+        ann_path = ann_path_for(manifest_path, version)
+        ann.save(ann_path + '.tmp')
+        os.replace(ann_path + '.tmp', ann_path)
+        ann_file = os.path.basename(ann_path)
+
+    # int8 codes are stored too, so the int8 mode maps them instead of
+    # re-quantizing (and paging in) the whole float32 matrix on every boot
+    codes_path, scales_path = int8_paths_for(manifest_path, version)
+    Int8Embeddings.from_matrix(matrix).save(codes_path + '.tmp', scales_path + '.tmp')
+    os.replace(codes_path + '.tmp', codes_path)
+    os.replace(scales_path + '.tmp', scales_path)
+
+    # BM25 postings are stored too, so serving maps them instead of tokenizing the catalog
+    lexical_files, lexical_checksum = None, None
+    if lexical is not None:
+        if lexical.size != len(ids):
+            raise ValueError(f"Got BM25 postings for {lexical.size} documents and {len(ids)} ids")
+        lexical_files = {}
+        for name, array in sorted(lexical.to_arrays().items()):
+            path = lexical_path_for(manifest_path, version, name)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + '.tmp', path)
+            lexical_files[name] = os.path.basename(path)
+        lexical_checksum = files_checksum(
+            [os.path.join(os.path.dirname(manifest_path), name) for name in lexical_files.values()])
+
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+
+    manifest = {
+        'format_version': FORMAT_VERSION,
+        'version': version,
+        'model': model_name,
+        'built_at': datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+        'embeddings_file': os.path.basename(embeddings_path),
+        'checksum': file_checksum(embeddings_path),
+        'ann_file': ann_file,
+        'int8_file': os.path.basename(codes_path),
+        'int8_scales_file': os.path.basename(scales_path),
+        'int8_checksum': file_checksum(codes_path),
+        'lexical_files': lexical_files,
+        'lexical_checksum': lexical_checksum,
+        'count': int(matrix.shape[0]),
+        'dim': int(matrix.shape[1]),
+        'dtype': 'float32',
+        'ids': list(ids),
+        'hashes': list(hashes),
+        'previous_files': sorted(artifact_files(previous)),
+    }
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    # Keep the previous version around for processes that still map it
+    _prune(manifest, previous, os.path.dirname(manifest_path))
+    return manifest
+
+
+def load_index(manifest_path=MANIFEST_PATH, verify=True):
+    """Open the embedding matrix as a read-only memmap alongside its manifest"""
+    if not os.path.exists(manifest_path):
+        raise IndexArtifactError(f"No embedding index at {manifest_path}; run `python -m app.build_index`")
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise IndexArtifactError(f"Unsupported index format in {manifest_path}; run `python -m app.build_index`")
+
+    embeddings_path = os.path.join(os.path.dirname(manifest_path), manifest['embeddings_file'])
+    if verify and file_checksum(embeddings_path) != manifest['checksum']:
+        raise IndexArtifactError(f"Checksum mismatch for {embeddings_path}")
+
+    matrix = np.load(embeddings_path, mmap_mode='r')
+    if matrix.dtype != np.float32 or matrix.shape != (manifest['count'], manifest['dim']):
+        raise IndexArtifactError(
+            f"Embedding file {embeddings_path} does not match its manifest "
+            f"({matrix.dtype}, {matrix.shape})"
+        )
+    return matrix, manifest
+
+
+def load_ann(manifest, manifest_path=MANIFEST_PATH):
+    """IVF index stored with the manifest, or None when it was built without one"""
+    if not manifest.get('ann_file'):
+        return None
+    return IVFIndex.load(os.path.join(os.path.dirname(manifest_path), manifest['ann_file']))
+
+
+def load_int8(manifest, manifest_path=MANIFEST_PATH, verify=True):
+    """Stored int8 codes mapped read-only, or None for indexes built without them"""
+    if not manifest.get('int8_file'):
+        return None
+    directory = os.path.dirname(manifest_path)
+    codes_path = os.path.join(directory, manifest['int8_file'])
+    if verify and file_checksum(codes_path) != manifest['int8_checksum']:
+        raise IndexArtifactError(f"Checksum mismatch for {codes_path}")
+    quantized = Int8Embeddings.load(codes_path, os.path.join(directory, manifest['int8_scales_file']))
+    if quantized.codes.shape != (manifest['count'], manifest['dim']):
+        raise IndexArtifactError(f"int8 codes in {codes_path} do not match their manifest")
+    return quantized
+
+
+def load_lexical(manifest, manifest_path=MANIFEST_PATH, verify=True):
+    """Stored BM25 postings mapped read-only, or None for indexes built without them"""
+    if not manifest.get('lexical_files'):
+        return None
+    directory = os.path.dirname(manifest_path)
+    paths = {name: os.path.join(directory, file) for name, file in manifest['lexical_files'].items()}
+    if verify and files_checksum(paths.values()) != manifest['lexical_checksum']:
+        raise IndexArtifactError(f"Checksum mismatch for the BM25 postings of index {manifest['version']}")
+    lexical = BM25Index.from_arrays({name: np.load(path, mmap_mode='r') for name, path in paths.items()})
+    if lexical.size != manifest['count'] or lexical.offsets.size != len(lexical.terms) + 1:
+        raise IndexArtifactError(f"BM25 postings of index {manifest['version']} do not match their manifest")
+    return lexical
@@ -0,0 +1,426 @@
+import bisect
+import copy
+import math
+import re
+import threading
+import numpy as np
+from app.ann import top_k
+
+# Keeps product-style tokens such as ".net", "ado.net", "c++" and "c#" intact
+TOKEN_RE = re.compile(r"\.?[a-z0-9][a-z0-9.+#]*")
+
+
+def tokenize(text):
+    """Lower-cased tokens; dotted tokens also yield their parts ('ado.net' -> 'ado', 'net')"""
+    tokens = []
+    for token in TOKEN_RE.findall((text or '').lower()):
+        token = token.rstrip('.')
+        if not token:
+            continue
+        tokens.append(token)
+        if '.' in token:
+            tokens.extend(part for part in token.split('.') if part)
+    return tokens
+
+
+def _term_counts(tokens):
+    counts = {}
+    for token in tokens:
+        counts[token] = counts.get(token, 0) + 1
+    return counts
+
+
+def _prefixes(encoded):
+    """First eight bytes of each (UTF-8) term as a big-endian integer, zero-padded"""
+    padded = b''.join(term[:8].ljust(8, b'\0') for term in encoded)
+    return np.frombuffer(padded, dtype='>u8').astype(np.uint64)
+
+
+class TermTable:
+    """
+    Sorted vocabulary stored as one UTF-8 blob plus offsets
+
+    Term i is `blob[offsets[i]:offsets[i + 1]]`. `prefixes` holds the first
+    eight bytes of every term as an integer, so looking up a batch of terms
+    is one searchsorted plus a binary search within the few terms sharing a
+    prefix. All three are flat arrays that can be stored and mapped read-only.
+    """
+
+    def __init__(self, blob, offsets, prefixes):
+        self.blob = blob
+        self.offsets = offsets
+        self.prefixes = prefixes
+
+    @classmethod
+    def from_terms(cls, terms):
+        encoded = sorted(term.encode('utf-8') for term in terms)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(term) for term in encoded])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return cls(blob, offsets, _prefixes(encoded))
+
+    def __len__(self):
+        return self.offsets.size - 1
+
+    def _bytes(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]])
+
+    def __getitem__(self, i):
+        return self._bytes(i).decode('utf-8')
+
+    def lookup(self, terms):
+        """Table positions of the given terms, None for terms not in the table"""
+        encoded = [term.encode('utf-8') for term in terms]
+        keys = _prefixes(encoded)
+        starts = np.searchsorted(self.prefixes, keys, side='left').tolist()
+        ends = np.searchsorted(self.prefixes, keys, side='right').tolist()
+        ids = []
+        for term, start, end in zip(encoded, starts, ends):
+            i = start + bisect.bisect_left(range(start, end), term, key=self._bytes)
+            ids.append(i if i < end and self._bytes(i) == term else None)
+        return ids
+
+
+def _table(terms):
+    """TermTable of `terms` and the table position of each term, in the given order"""
+    order = sorted(range(len(terms)), key=lambda i: terms[i].encode('utf-8'))
+    rank = np.empty(len(terms), dtype=np.int64)
+    rank[order] = np.arange(len(terms))
+    return TermTable.from_terms(terms), rank
+
+
+class _Changes:
+    """
+    Append-only record of the documents added and removed since a CSR block was built
+
+    It is shared by the indexes derived from one another. Each index reads
+    only the prefix it has seen (its own event count and size), so an index
+    derived with `copy` appends past that prefix without changing what the
+    index it came from returns. Every add or remove is one event. Appends
+    take `lock`; an index that isn't the newest of its lineage appends to a
+    copy of its own prefix instead.
+    """
+
+    def __init__(self):
+        # Terms the block doesn't have, numbered after its own
+        self.vocabulary = {}
+        # term id -> ([doc ids], [tfs]) of added documents, in doc id order
+        self.postings = {}
+        # term id -> [(event, document frequency change up to and including it)]
+        self.df = {}
+        # Lengths of added documents, in doc id order
+        self.lengths = []
+        # [(event, doc id)] of removed documents, and doc id -> event
+        self.deleted = []
+        self.deleted_at = {}
+        self.events = 0
+        self.lock = threading.Lock()
+
+    def prefix(self, index):
+        """Copy of the changes as `index` sees them"""
+        changes = _Changes()
+        changes.vocabulary = dict(self.vocabulary)
+        for term_id, (docs, tfs) in list(self.postings.items()):
+            k = bisect.bisect_left(docs, index.size)
+            if k:
+                changes.postings[term_id] = (docs[:k], tfs[:k])
+        for term_id, entries in list(self.df.items()):
+            k = bisect.bisect_left(entries, (index.events,))
+            if k:
+                changes.df[term_id] = entries[:k]
+        changes.lengths = self.lengths[:index.size - index.base_size]
+        changes.deleted = self.deleted[:bisect.bisect_left(self.deleted, (index.events,))]
+        changes.deleted_at = {doc_id: event for event, doc_id in changes.deleted}
+        changes.events = index.events
+        return changes
+
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index with array-backed postings
+
+    Postings of the base documents live in one CSR block (`offsets`,
+    `doc_ids`, `tfs`) over a sorted TermTable. The block is built offline
+    with the embedding index and mapped from its files at load, so serving
+    never tokenizes the catalog. `add` appends a new document's postings to
+    a record of changes and `remove` tombstones one, so single-item updates
+    don't touch the block; `select` merges everything into a fresh block
+    when the catalog is compacted. A catalog snapshot never changes an index
+    another snapshot is reading: it takes a `copy` first, which shares the
+    block and the record of changes, and applies its changes to that.
+
+    Reads take no lock. An index only changes before its snapshot is
+    published, and what other indexes append to the shared record lies past
+    the prefix it reads; only appends to the record are serialized, by its
+    own lock.
+    """
+
+    def __init__(self, terms=None, offsets=None, doc_ids=None, tfs=None, doc_lengths=None, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = terms if terms is not None else TermTable.from_terms([])
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        self.doc_ids = doc_ids if doc_ids is not None else np.zeros(0, dtype=np.int32)
+        self.tfs = tfs if tfs is not None else np.zeros(0, dtype=np.uint16)
+        self.doc_lengths = doc_lengths if doc_lengths is not None else np.zeros(0, dtype=np.float32)
+        self.base_size = self.doc_lengths.size
+        self.size = self.base_size
+        self.live_docs = self.base_size
+        self.total_length = float(np.sum(self.doc_lengths, dtype=np.float64))
+        # Changes since the block was built, of which this index sees the first `events`
+        self._changes = _Changes()
+        self.events = 0
+
+    @classmethod
+    def build(cls, texts, k1=1.5, b=0.75):
+        """Index documents 0, 1, ... straight into a CSR block"""
+        vocabulary, term_ids, doc_ids, tfs, lengths = {}, [], [], [], []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            for term, tf in _term_counts(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                doc_ids.append(doc_id)
+                tfs.append(tf)
+            lengths.append(len(tokens))
+
+        terms, rank = _table(list(vocabulary))
+        return cls._from_postings(
+            terms, rank[np.array(term_ids, dtype=np.int64)], np.array(doc_ids, dtype=np.int32),
+            np.array(tfs, dtype=np.int64), np.array(lengths, dtype=np.float32), k1, b
+        )
+
+    @classmethod
+    def _from_postings(cls, terms, term_ids, doc_ids, tfs, doc_lengths, k1, b):
+        """CSR block from parallel (table position, document, tf) arrays"""
+        order = np.lexsort((doc_ids, term_ids))
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(terms)))
+        tfs = np.minimum(tfs[order], np.iinfo(np.uint16).max).astype(np.uint16)
+        return cls(terms, offsets, doc_ids[order].astype(np.int32), tfs, doc_lengths, k1=k1, b=b)
+
+    def to_arrays(self):
+        """The CSR block and its term table as flat arrays, for storing or sharing; changes are not included"""
+        return {
+            'lexical_terms': self.terms.blob,
+            'lexical_term_offsets': self.terms.offsets,
+            'lexical_term_prefixes': self.terms.prefixes,
+            'lexical_offsets': self.offsets,
+            'lexical_doc_ids': self.doc_ids,
+            'lexical_tfs': self.tfs,
+            'lexical_doc_lengths': self.doc_lengths,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, k1=1.5, b=0.75):
+        """Rebuild from `to_arrays` output; the block stays views into the given arrays"""
+        terms = TermTable(arrays['lexical_terms'], arrays['lexical_term_offsets'], arrays['lexical_term_prefixes'])
+        return cls(terms, arrays['lexical_offsets'], arrays['lexical_doc_ids'], arrays['lexical_tfs'],
+                   arrays['lexical_doc_lengths'], k1=k1, b=b)
+
+    def copy(self):
+        """
+        Index for a new catalog snapshot, in O(1)
+
+        The copy shares the CSR block, which is never written, and the
+        append-only record of changes, of which this index only ever reads
+        the part it has seen; changes to the copy leave this index as it was.
+        """
+        return copy.copy(self)
+
+    def _term_ids(self, terms):
+        """Ids of the given terms, None for unknown ones"""
+        ids = self.terms.lookup(terms)
+        vocabulary = self._changes.vocabulary
+        return [vocabulary.get(term) if term_id is None else term_id for term, term_id in zip(terms, ids)]
+
+    def _df_change(self, term_id):
+        entries = self._changes.df.get(term_id, ())
+        k = bisect.bisect_left(entries, (self.events,))
+        return entries[k - 1][1] if k else 0
+
+    def _df(self, term_id):
+        df = self._df_change(term_id)
+        if term_id < len(self.terms):
+            df += int(self.offsets[term_id + 1] - self.offsets[term_id])
+        return df
+
+    def _length(self, doc_id):
+        if doc_id < self.base_size:
+            return float(self.doc_lengths[doc_id])
+        return self._changes.lengths[doc_id - self.base_size]
+
+    def _deleted(self):
+        """Documents this index has seen removed"""
+        deleted = self._changes.deleted
+        return [doc_id for _, doc_id in deleted[:bisect.bisect_left(deleted, (self.events,))]]
+
+    def _is_deleted(self, doc_id):
+        return self._changes.deleted_at.get(doc_id, self.events) < self.events
+
+    def add(self, doc_id, text):
+        """Index a new document under `doc_id` (a catalog row), which must be the next one"""
+        with self._changes.lock:
+            self._add(doc_id, text)
+
+    def remove(self, doc_id, text):
+        """Tombstone a document; `text` must be what it was indexed with"""
+        with self._changes.lock:
+            self._remove(doc_id, text)
+
+    def select(self, rows):
+        """
+        New index over the given documents, renumbered 0..len(rows)-1
+
+        Block and added postings are merged into one fresh CSR block, so the
+        result has no pending changes. Used to compact the catalog, and to
+        follow the catalog's row order when it differs from the stored index.
+        """
+        return self._select(np.asarray(rows, dtype=np.int64))
+
+    def scores(self, query, size=None):
+        """Dense BM25 score vector over document ids 0..size-1 (0 for non-matching documents)"""
+        return self._scores(query, self.size if size is None else size)
+
+    def _append_to(self):
+        """The changes to append to; call with their lock held"""
+        if self._changes.events != self.events:
+            # A newer index of this lineage already appended to the shared record
+            self._changes = self._changes.prefix(self)
+        return self._changes
+
+    def _count(self, changes, term_id, event, change):
+        entries = changes.df.setdefault(term_id, [])
+        entries.append((event, (entries[-1][1] if entries else 0) + change))
+
+    def _add(self, doc_id, text):
+        if doc_id != self.size:
+            raise ValueError(f"Documents are added in order: expected {self.size}, got {doc_id}")
+
+        changes = self._append_to()
+        tokens = tokenize(text)
+        terms = _term_counts(tokens)
+        for (term, tf), term_id in zip(terms.items(), self._term_ids(list(terms))):
+            if term_id is None:
+                term_id = changes.vocabulary[term] = len(self.terms) + len(changes.vocabulary)
+            self._count(changes, term_id, changes.events, 1)
+            docs, tfs = changes.postings.setdefault(term_id, ([], []))
+            docs.append(doc_id)
+            tfs.append(min(tf, np.iinfo(np.uint16).max))
+        changes.lengths.append(float(len(tokens)))
+        changes.events += 1
+
+        self.events = changes.events
+        self.size += 1
+        self.live_docs += 1
+        self.total_length += len(tokens)
+
+    def _remove(self, doc_id, text):
+        if doc_id >= self.size or self._is_deleted(doc_id):
+            return
+        changes = self._append_to()
+        for term_id in self._term_ids(list(_term_counts(tokenize(text)))):
+            if term_id is not None:
+                self._count(changes, term_id, changes.events, -1)
+        changes.deleted.append((changes.events, doc_id))
+        changes.deleted_at[doc_id] = changes.events
+        changes.events += 1
+
+        self.events = changes.events
+        self.live_docs -= 1
+        self.total_length -= self._length(doc_id)
+
+    def _select(self, rows):
+        new_id = np.full(self.size, -1, dtype=np.int64)
+        new_id[rows] = np.arange(rows.size)
+
+        # Terms first: every term of a document this index has seen is already in it
+        vocabulary = list(self._changes.vocabulary)
+        term_ids = [np.repeat(np.arange(len(self.terms), dtype=np.int64), np.diff(self.offsets))]
+        doc_ids, tfs = [np.asarray(self.doc_ids, dtype=np.int64)], [np.asarray(self.tfs, dtype=np.int64)]
+        for term_id in list(self._changes.postings):
+            docs, term_tfs = self._added_postings(term_id)
+            term_ids.append(np.full(len(docs), term_id, dtype=np.int64))
+            doc_ids.append(np.array(docs, dtype=np.int64))
+            tfs.append(np.array(term_tfs, dtype=np.int64))
+        term_ids, doc_ids, tfs = (np.concatenate(parts) for parts in (term_ids, doc_ids, tfs))
+
+        terms = self.terms
+        if vocabulary:
+            # Terms added since the block was built take their place in a new table
+            terms, rank = _table([self.terms[i] for i in range(len(self.terms))] + vocabulary)
+            term_ids = rank[term_ids]
+
+        keep = new_id[doc_ids] >= 0
+        lengths = np.concatenate([self.doc_lengths, self._added_lengths()])
+        return self._from_postings(terms, term_ids[keep], new_id[doc_ids[keep]], tfs[keep],
+                                   lengths[rows], self.k1, self.b)
+
+    def _added_postings(self, term_id):
+        """(doc ids, tfs) lists of a term in the documents added up to this index"""
+        docs, tfs = self._changes.postings.get(term_id, ((), ()))
+        k = bisect.bisect_left(docs, self.size)
+        return docs[:k], tfs[:k]
+
+    def _added_lengths(self):
+        return np.array(self._changes.lengths[:self.size - self.base_size], dtype=np.float32)
+
+    def _postings(self, term_id):
+        """(doc_ids, tfs) for a term across the CSR block and the added documents"""
+        if term_id < len(self.terms):
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs, tfs = self.doc_ids[start:end], self.tfs[start:end]
+        else:
+            docs, tfs = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.uint16)
+        added_docs, added_tfs = self._added_postings(term_id)
+        if added_docs:
+            docs = np.concatenate([docs, np.array(added_docs, dtype=np.int32)])
+            tfs = np.concatenate([tfs, np.array(added_tfs, dtype=np.uint16)])
+        return docs, tfs
+
+    def _doc_lengths(self, docs, appended):
+        """Lengths of block and added documents; `appended` holds the added ones"""
+        base = docs < self.base_size
+        if base.all():
+            return self.doc_lengths[docs]
+        lengths = np.empty(docs.size, dtype=np.float32)
+        lengths[base] = self.doc_lengths[docs[base]]
+        lengths[~base] = appended[docs[~base] - self.base_size]
+        return lengths
+
+    def _scores(self, query, size):
+        scores = np.zeros(size, dtype=np.float32)
+        if self.live_docs == 0:
+            return scores
+        avg_length = self.total_length / self.live_docs or 1.0
+        appended = self._added_lengths()
+
+        terms = list(set(tokenize(query)))
+        for term_id in self._term_ids(terms):
+            if term_id is None:
+                continue
+            df = self._df(term_id)
+            if df <= 0:
+                continue
+            docs, tfs = self._postings(term_id)
+            # A caller asking for fewer documents than the index has gets only those
+            in_range = docs < size
+            docs, tfs = docs[in_range], tfs[in_range]
+            if docs.size == 0:
+                continue
+            idf = math.log(1.0 + (self.live_docs - df + 0.5) / (df + 0.5))
+            tf = tfs.astype(np.float32)
+            norm = self.k1 * (1.0 - self.b + self.b * self._doc_lengths(docs, appended) / avg_length)
+            scores[docs] += idf * tf * (self.k1 + 1.0) / (tf + norm)
+
+        deleted = [doc_id for doc_id in self._deleted() if doc_id < size]
+        scores[deleted] = 0.0
+        return scores
+
+    def search(self, query, k, mask=None):
+        """Top-k matching documents, optionally restricted to a row mask"""
+        scores = self.scores(query, None if mask is None else mask.size)
+        if mask is not None:
+            scores[~mask] = 0.0
+        matching = np.flatnonzero(scores > 0)
+        top = top_k(scores[matching], k)
+        return matching[top], scores[matching][top]
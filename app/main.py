@@ -1,42 +1,197 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any, Optional
-from pydantic import BaseModel
+from starlette.background import BackgroundTask
+from typing import Dict, Any, List, Optional
+import asyncio
+import functools
 import json
 import os
-from datetime import datetime
+import secrets
+import time
+from app.models import (
+    AssessmentUpsert,
+    BatchRecommendationRequest,
+    BatchRecommendationResponse,
+    CleanRecommendationResponse,
+    RecommendationRequest
+)
+from app.batching import QueryBatcher
+from app.cache import DiskResultStore, ResultCache, SemanticCache
+from app.concurrency import QueueFullError, RecommenderPool
+from app.engine import RecommenderEngine
+from app.recommender import QueryTooLongError, SHLRecommender
+from app.telemetry import Metrics, StageTimer
+from app.utils import clean_recommendations, get_current_timestamp
 
 # Constants
-CURRENT_TIME = "2025-04-08 21:56:56"
 CURRENT_USER = "saurabhbisht076"
+STARTED_AT = time.time()
+QUERY_BATCH_SIZE = int(os.environ.get("QUERY_BATCH_SIZE", 32))
+QUERY_BATCH_WAIT_MS = float(os.environ.get("QUERY_BATCH_WAIT_MS", 5))
+RECOMMENDER_THREADS = int(os.environ.get("RECOMMENDER_THREADS", 0)) or None
+RECOMMENDER_MAX_PENDING = int(os.environ.get("RECOMMENDER_MAX_PENDING", 64))
+RECOMMENDER_RETRY_AFTER = int(os.environ.get("RECOMMENDER_RETRY_AFTER", 1))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 300))
+RESULT_CACHE_ENTRIES = int(os.environ.get("RESULT_CACHE_ENTRIES", 2048))
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", 32 * 1024 * 1024))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+RESULT_CACHE_DIR_ENTRIES = int(os.environ.get("RESULT_CACHE_DIR_ENTRIES", 10000))
+RESULT_CACHE_DIR_BYTES = int(os.environ.get("RESULT_CACHE_DIR_BYTES", 256 * 1024 * 1024))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", 1000))
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 32))
+SEMANTIC_CACHE_SIZE = int(os.environ.get("SEMANTIC_CACHE_SIZE", 1024))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.97))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", RESULT_CACHE_TTL))
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "hybrid")
+RETRIEVAL_FUSION = os.environ.get("RETRIEVAL_FUSION", "rrf")
+LEXICAL_CANDIDATES = int(os.environ.get("LEXICAL_CANDIDATES", 0)) or None
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "sentence-transformers")
+SHARED_INDEX_DIR = os.environ.get("SHARED_INDEX_DIR") or None
+RELOAD_POLL_SECONDS = float(os.environ.get("RELOAD_POLL_SECONDS", 30))
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+MAX_QUERY_CHARS = int(os.environ.get("MAX_QUERY_CHARS", 20000))
+COMPACT_THRESHOLD = int(os.environ.get("COMPACT_THRESHOLD", 1000))
+COMPACT_INTERVAL_SECONDS = float(os.environ.get("COMPACT_INTERVAL_SECONDS", 3600))
+ANN_NPROBE = int(os.environ.get("ANN_NPROBE", 8))
+EMBEDDING_MODE = os.environ.get("EMBEDDING_MODE", "float32")
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", 4))
+SEARCH_SHARDS = int(os.environ.get("SEARCH_SHARDS", 0))
+SHARD_MIN_ROWS = int(os.environ.get("SHARD_MIN_ROWS", 200000))
+VERIFY_INDEX = os.environ.get("VERIFY_INDEX", "1") != "0"
+LOAD_RETRIES = int(os.environ.get("LOAD_RETRIES", 5))
+LOAD_RETRY_SECONDS = float(os.environ.get("LOAD_RETRY_SECONDS", 2))
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", 5))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One recommender per worker process, loaded and warmed up in the background
+    # so liveness probes are answered while the model loads
+    app.state.engine = RecommenderEngine(functools.partial(
+        SHLRecommender,
+        verify_index=VERIFY_INDEX,
+        ann_nprobe=ANN_NPROBE,
+        embedding_mode=EMBEDDING_MODE,
+        rerank_factor=RERANK_FACTOR,
+        retrieval_mode=RETRIEVAL_MODE,
+        fusion=RETRIEVAL_FUSION,
+        lexical_candidates=LEXICAL_CANDIDATES,
+        max_query_chars=MAX_QUERY_CHARS,
+        encoder_backend=ENCODER_BACKEND,
+        shared_dir=SHARED_INDEX_DIR,
+        shards=SEARCH_SHARDS,
+        shard_min_rows=SHARD_MIN_ROWS
+    ), poll_seconds=RELOAD_POLL_SECONDS, compact_seconds=COMPACT_INTERVAL_SECONDS,
+        # The change log is written next to the catalog; without admin the data directory can be read-only
+        change_log=bool(ADMIN_TOKEN),
+        load_retries=LOAD_RETRIES, retry_seconds=LOAD_RETRY_SECONDS)
+    app.state.engine.start()
+
+    # Encoding and scoring run on a bounded pool, never on the event loop
+    app.state.pool = RecommenderPool(
+        max_workers=RECOMMENDER_THREADS,
+        max_pending=RECOMMENDER_MAX_PENDING,
+        retry_after=RECOMMENDER_RETRY_AFTER
+    )
+
+    # Concurrent /recommend queries share one encoder call
+    app.state.batcher = QueryBatcher(
+        app.state.engine.encode_queries,
+        max_batch_size=QUERY_BATCH_SIZE,
+        max_wait_ms=QUERY_BATCH_WAIT_MS,
+        run_blocking=app.state.pool.run
+    )
+    app.state.batcher.start()
 
-# Pydantic Models
-class RecommendationRequest(BaseModel):
-    query: str
-    job_level: Optional[str] = None
-    max_duration: Optional[int] = None
-    languages: Optional[List[str]] = None
-    test_type: Optional[str] = None
-    top_n: Optional[int] = 5
-
-class AssessmentResponse(BaseModel):
-    id: str
-    name: str
-    description: str
-    score: float
-    job_levels: List[str]
-    duration: int
-    test_type: str
-
-class CleanRecommendationResponse(BaseModel):
-    recommended_assessments: List[AssessmentResponse]
+    # Serialized /recommend responses, optionally shared through a local directory
+    app.state.result_cache = ResultCache(
+        ttl_seconds=RESULT_CACHE_TTL,
+        max_entries=RESULT_CACHE_ENTRIES,
+        max_bytes=RESULT_CACHE_BYTES,
+        disk=DiskResultStore(
+            RESULT_CACHE_DIR,
+            RESULT_CACHE_TTL,
+            max_entries=RESULT_CACHE_DIR_ENTRIES,
+            max_bytes=RESULT_CACHE_DIR_BYTES
+        ) if RESULT_CACHE_DIR else None,
+        # Requests still finishing on a replaced snapshot must not reset the cache
+        current_version=lambda: app.state.engine.version
+    )
+
+    # Near-duplicate queries (templated job postings) reuse an earlier ranking
+    app.state.semantic_cache = SemanticCache(
+        capacity=SEMANTIC_CACHE_SIZE,
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl_seconds=SEMANTIC_CACHE_TTL
+    )
+    app.state.compaction = None
+
+    # Per-stage latency histograms and request counts for /metrics, shared by
+    # all workers through METRICS_DIR when it is set
+    app.state.metrics = Metrics(directory=METRICS_DIR)
+    flusher = asyncio.create_task(flush_metrics(app.state)) if METRICS_DIR else None
+    yield
+    if flusher is not None:
+        flusher.cancel()
+        app.state.metrics.flush(metric_families(app.state))
+    await app.state.batcher.stop()
+    app.state.pool.shutdown()
+    app.state.engine.stop()
 
 app = FastAPI(
     title="SHL Assessment Recommender API",
     description="API for recommending SHL assessments based on job descriptions and criteria",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+def get_recommender(request: Request) -> SHLRecommender:
+    engine = request.app.state.engine
+    if not engine.ready:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Recommender is {engine.status}",
+            headers={"Retry-After": "5"}
+        )
+    return engine.recommender
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # Fail closed: without ADMIN_TOKEN the admin endpoints are disabled
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled; set ADMIN_TOKEN to enable them")
+    if not secrets.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.exception_handler(QueueFullError)
+async def queue_full_handler(request: Request, exc: QueueFullError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+@app.exception_handler(QueryTooLongError)
+async def query_too_long_handler(request: Request, exc: QueryTooLongError):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+def result_cache_key(recommender: SHLRecommender, request: RecommendationRequest) -> str:
+    return ResultCache.make_key(
+        recommender.version,
+        request.query,
+        job_level=request.job_level,
+        max_duration=request.max_duration,
+        languages=request.languages,
+        test_type=request.test_type,
+        top_n=request.top_n
+    )
+
+def filter_group(request: RecommendationRequest) -> tuple:
+    """Requests with the same filters can be scored together"""
+    languages = tuple(sorted(request.languages)) if request.languages else None
+    return (request.job_level, request.max_duration, languages, request.test_type, request.top_n)
+
 # CORS for frontend communication
 app.add_middleware(
     CORSMiddleware,
@@ -46,116 +201,392 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Mock data for initial deployment
-MOCK_ASSESSMENTS = {
-    "assessments": [
-        {
-            "id": "SHL001",
-            "name": "Verbal Reasoning",
-            "description": "Evaluates ability to understand and analyze written information",
-            "score": 0.95,
-            "duration": 30,
-            "job_levels": ["entry", "mid"],
-            "test_type": "cognitive",
-            "languages": ["en"]
-        },
-        {
-            "id": "SHL002",
-            "name": "Numerical Reasoning",
-            "description": "Tests ability to analyze numerical data and make logical decisions",
-            "score": 0.88,
-            "duration": 45,
-            "job_levels": ["mid", "senior"],
-            "test_type": "cognitive",
-            "languages": ["en", "es"]
-        },
-        {
-            "id": "SHL003",
-            "name": "Leadership Assessment",
-            "description": "Evaluates leadership potential and management capabilities",
-            "score": 0.92,
-            "duration": 60,
-            "job_levels": ["senior"],
-            "test_type": "behavioral",
-            "languages": ["en"]
-        }
-    ]
-}
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    """Time every request, report its stages in Server-Timing and record them for /metrics"""
+    timer = request.state.timer = StageTimer()
+    start = time.perf_counter()
+    response = await call_next(request)
+    timer.add("total", time.perf_counter() - start)
+
+    # The route template, not the raw path, so unknown URLs don't add series
+    route = request.scope.get("route")
+    endpoint = getattr(route, "path", "unmatched")
+    metrics = request.app.state.metrics
+    metrics.count(endpoint, response.status_code)
+    metrics.observe(endpoint, timer)
+    response.headers["Server-Timing"] = timer.header()
+    return response
+
+async def timed_run(pool: RecommenderPool, timer: StageTimer, fn, *args, **kwargs):
+    """Run a recommender call on the pool, recording its stages and the wait for a thread"""
+    timings = {}
+    start = time.perf_counter()
+    result = await pool.run(fn, *args, timings=timings, **kwargs)
+    timer.update(timings)
+    # Whatever the call didn't spend computing was spent queued for a thread
+    timer.add("queue", time.perf_counter() - start - sum(timings.values()))
+    return result
 
 @app.get("/")
 async def read_root():
     return {
         "message": "Welcome to SHL Assessment Recommender API",
-        "timestamp": CURRENT_TIME,
+        "timestamp": get_current_timestamp(),
         "user": CURRENT_USER,
         "status": "running"
     }
 
 @app.get("/health")
-async def health_check():
-    return {
-        "status": "healthy",
-        "timestamp": CURRENT_TIME,
+async def health_check(request: Request):
+    # Liveness: answers as soon as the process is up, and fails once loading
+    # has given up so the orchestrator restarts the worker
+    engine = request.app.state.engine
+    failed = engine.status == engine.FAILED and not engine.retrying
+    body = {
+        "status": "unhealthy" if failed else "healthy",
+        "engine": engine.status,
+        "error": engine.error,
+        "load_attempts": engine.load_attempts,
+        "version": engine.recommender.version if engine.ready else None,
+        "reloads": engine.reloads,
+        "reload_error": engine.reload_error,
+        "pending_changes": engine.recommender.delta.changes if engine.ready else None,
+        "timings": {k: round(v, 3) for k, v in engine.timings.items()},
+        "query_cache": engine.recommender.query_cache.stats() if engine.ready else None,
+        "result_cache": request.app.state.result_cache.stats(),
+        "semantic_cache": request.app.state.semantic_cache.stats(),
+        "uptime_seconds": round(time.time() - STARTED_AT, 1),
+        "timestamp": get_current_timestamp(),
         "user": CURRENT_USER
     }
+    if failed:
+        return JSONResponse(status_code=503, content=body)
+    return body
+
+@app.get("/health/ready")
+async def readiness_check(request: Request):
+    # Readiness: only green once the model and index are loaded and warmed up
+    engine = request.app.state.engine
+    body = {"status": engine.status, "timestamp": get_current_timestamp()}
+    if not engine.ready:
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": "5"})
+    body["index_version"] = engine.recommender.index_version
+    body["version"] = engine.recommender.version
+    return body
+
+def metric_families(state) -> List[tuple]:
+    """This worker's cache, queue and catalog metrics, as taken by Metrics.render"""
+    engine = state.engine
+    recommender = engine.recommender if engine.ready else None
+    caches = {"result": state.result_cache.stats(), "semantic": state.semantic_cache.stats()}
+    if recommender is not None:
+        caches["query_embedding"] = recommender.query_cache.stats()
+
+    def per_cache(field):
+        return [({"cache": name}, stats[field]) for name, stats in caches.items()]
+
+    families = [
+        ("shl_cache_hits_total", "counter", "Cache lookups that hit", per_cache("hits")),
+        ("shl_cache_misses_total", "counter", "Cache lookups that missed", per_cache("misses")),
+        ("shl_cache_hit_ratio", "gauge", "Hits over lookups since the worker started", per_cache("hit_rate")),
+        ("shl_cache_entries", "gauge", "Entries held per cache", per_cache("entries")),
+        ("shl_pool_in_flight", "gauge", "Requests admitted to the recommender pool", [({}, state.pool.in_flight)]),
+        ("shl_pool_max_pending", "gauge", "Admission limit of the recommender pool", [({}, state.pool.max_pending)]),
+        ("shl_pool_rejected_total", "counter", "Requests rejected with 503 at capacity", [({}, state.pool.rejected)]),
+        ("shl_batcher_queue_depth", "gauge", "Queries waiting for the next encoder batch",
+         [({}, state.batcher.queue_depth)]),
+        ("shl_batcher_batches_total", "counter", "Encoder batches run by the query batcher",
+         [({}, state.batcher.batches)]),
+        ("shl_batcher_queries_total", "counter", "Queries encoded by the query batcher", [({}, state.batcher.items)]),
+        ("shl_engine_ready", "gauge", "1 once the recommender is loaded and warmed up", [({}, int(engine.ready))]),
+        ("shl_reloads_total", "counter", "Catalog snapshots swapped in since start", [({}, engine.reloads)]),
+        ("shl_uptime_seconds", "gauge", "Seconds since the worker started", [({}, time.time() - STARTED_AT)]),
+    ]
+    if recommender is not None:
+        families += [
+            ("shl_catalog_assessments", "gauge", "Assessments currently served",
+             [({}, recommender.delta.live_size)]),
+            ("shl_catalog_pending_changes", "gauge", "Admin changes not compacted yet",
+             [({}, recommender.delta.changes)]),
+            ("shl_snapshot_info", "gauge", "Serving catalog and index snapshot",
+             [({"index_version": recommender.index_version, "version": recommender.version}, 1)]),
+        ]
+    return families
+
+async def flush_metrics(state):
+    """Keep this worker's file in METRICS_DIR fresh for the workers answering /metrics"""
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(state.metrics.flush, metric_families(state))
+        except OSError as e:
+            print(f"Could not write metrics to {METRICS_DIR}: {e}")
+
+@app.get("/metrics")
+async def metrics(request: Request):
+    """Prometheus text exposition of stage latencies, caches, queues and catalog (all workers with METRICS_DIR)"""
+    state = request.app.state
+    body = await asyncio.to_thread(state.metrics.render, metric_families(state))
+    return Response(content=body, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/assessments", response_model=Dict[str, Any])
-async def get_all_assessments():
-    return MOCK_ASSESSMENTS
+async def get_all_assessments(recommender: SHLRecommender = Depends(get_recommender)):
+    return recommender.catalog_dict()
+
+@app.get("/assessments/stream")
+async def stream_all_assessments(recommender: SHLRecommender = Depends(get_recommender)):
+    """NDJSON: one assessment per line, built lazily from the columnar catalog"""
+    def lines():
+        for record in recommender.records():
+            yield (json.dumps(record) + "\n").encode("utf-8")
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
 
 @app.post("/recommend", response_model=CleanRecommendationResponse)
-async def get_recommendations(request: RecommendationRequest):
-    try:
-        # Filter assessments based on criteria
-        filtered_assessments = MOCK_ASSESSMENTS["assessments"]
-        
-        if request.job_level:
-            filtered_assessments = [
-                a for a in filtered_assessments 
-                if request.job_level in a["job_levels"]
-            ]
-            
-        if request.max_duration:
-            filtered_assessments = [
-                a for a in filtered_assessments 
-                if a["duration"] <= request.max_duration
-            ]
-            
-        if request.languages:
-            filtered_assessments = [
-                a for a in filtered_assessments 
-                if any(lang in a["languages"] for lang in request.languages)
-            ]
+async def get_recommendations(request: RecommendationRequest, http_request: Request,
+                              recommender: SHLRecommender = Depends(get_recommender)):
+    recommender.validate_query(request.query)
+
+    # Hot queries are answered straight from the serialized result cache
+    timer = http_request.state.timer
+    result_cache = http_request.app.state.result_cache
+    with timer.stage("cache"):
+        cache_key = result_cache_key(recommender, request)
+        cached = (await result_cache.lookup([cache_key], recommender.version))[0]
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    pool = http_request.app.state.pool
+    semantic_cache = http_request.app.state.semantic_cache
+    with pool.admit():
+        try:
+            with timer.stage("encode"):
+                query_embedding = await http_request.app.state.batcher.encode(request.query)
+            with timer.stage("cache"):
+                payload = semantic_cache.get(query_embedding, filter_group(request), recommender.version)
+            if payload is not None:
+                result_cache.put(cache_key, recommender.version, payload)
+                return Response(content=payload, media_type="application/json")
+
+            recommendations = await timed_run(
+                pool,
+                timer,
+                recommender.get_recommendations,
+                request.query,
+                job_level=request.job_level,
+                duration_max=request.max_duration,
+                languages=request.languages,
+                test_type=request.test_type,
+                top_n=request.top_n,
+                query_embedding=query_embedding
+            )
             
-        if request.test_type:
-            filtered_assessments = [
-                a for a in filtered_assessments 
-                if a["test_type"] == request.test_type
-            ]
-        
-        # Limit to top_n results
-        if request.top_n:
-            filtered_assessments = filtered_assessments[:request.top_n]
-        
-        return CleanRecommendationResponse(
-            recommended_assessments=filtered_assessments
+            with timer.stage("serialize"):
+                payload = CleanRecommendationResponse(
+                    recommended_assessments=clean_recommendations(recommendations)
+                ).model_dump_json().encode("utf-8")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Recommendation error: {str(e)}")
+
+    semantic_cache.put(query_embedding, filter_group(request), recommender.version, payload)
+    result_cache.put(cache_key, recommender.version, payload)
+    return Response(content=payload, media_type="application/json")
+
+async def batch_payloads(requests: List[RecommendationRequest], recommender: SHLRecommender,
+                         app_state, timer: StageTimer) -> List[bytes]:
+    """Serialized responses for a list of requests, computing only result cache misses"""
+    result_cache = app_state.result_cache
+    version = recommender.version
+    with timer.stage("cache"):
+        keys = [result_cache_key(recommender, r) for r in requests]
+        payloads = await result_cache.lookup(keys, version)
+    missing = [i for i, payload in enumerate(payloads) if payload is None]
+    if not missing:
+        return payloads
+
+    pool = app_state.pool
+    # One encoder call for every query in the batch
+    with timer.stage("encode"):
+        embeddings = await pool.run(recommender.encode_queries, [requests[i].query for i in missing])
+    row_of = {i: j for j, i in enumerate(missing)}
+
+    # Near-duplicates of recent queries are served from the semantic cache
+    semantic_cache = app_state.semantic_cache
+    with timer.stage("cache"):
+        for i in missing:
+            payloads[i] = semantic_cache.get(embeddings[row_of[i]], filter_group(requests[i]), version)
+            if payloads[i] is not None:
+                result_cache.put(keys[i], version, payloads[i])
+
+    # One matrix-matrix product per distinct filter combination
+    groups = {}
+    for i in missing:
+        if payloads[i] is None:
+            groups.setdefault(filter_group(requests[i]), []).append(i)
+    for (job_level, max_duration, languages, test_type, top_n), members in groups.items():
+        results = await timed_run(
+            pool,
+            timer,
+            recommender.get_recommendations_batch,
+            [requests[i].query for i in members],
+            job_level=job_level,
+            duration_max=max_duration,
+            languages=list(languages) if languages else None,
+            test_type=test_type,
+            top_n=top_n,
+            query_embeddings=embeddings[[row_of[i] for i in members]]
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Recommendation error: {str(e)}")
+        with timer.stage("serialize"):
+            for i, recommendations in zip(members, results):
+                payloads[i] = CleanRecommendationResponse(
+                    recommended_assessments=clean_recommendations(recommendations)
+                ).model_dump_json().encode("utf-8")
+                semantic_cache.put(embeddings[row_of[i]], filter_group(requests[i]), version, payloads[i])
+                result_cache.put(keys[i], version, payloads[i])
+    return payloads
+
+@app.post("/recommend/batch", response_model=BatchRecommendationResponse)
+async def get_recommendations_batch(batch: BatchRecommendationRequest, http_request: Request,
+                                    recommender: SHLRecommender = Depends(get_recommender)):
+    if len(batch.requests) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_SIZE} requests per batch")
+    for request in batch.requests:
+        recommender.validate_query(request.query)
+
+    with http_request.app.state.pool.admit():
+        try:
+            payloads = await batch_payloads(batch.requests, recommender, http_request.app.state,
+                                            http_request.state.timer)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Recommendation error: {str(e)}")
+
+    # Stitch the per-query JSON documents together without re-serializing them
+    return Response(content=b'{"results":[' + b",".join(payloads) + b"]}", media_type="application/json")
+
+@app.post("/recommend/batch/stream")
+async def stream_recommendations_batch(batch: BatchRecommendationRequest, http_request: Request,
+                                       recommender: SHLRecommender = Depends(get_recommender)):
+    """NDJSON: one {"index", "result"} line per request, emitted chunk by chunk"""
+    if len(batch.requests) > BATCH_MAX_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_SIZE} requests per batch")
+    for request in batch.requests:
+        recommender.validate_query(request.query)
+
+    # Take the slot while a proper status code can still be sent, so a full
+    # pool can't cut the stream short once the 200 is out. It is released
+    # when the body ends, or by the background task if the body never starts
+    pool = http_request.app.state.pool
+    release = pool.reserve()
+
+    # Chunks are computed after the headers went out, so their stages are
+    # recorded for /metrics when the stream ends rather than in Server-Timing
+    timer = StageTimer()
+
+    async def lines():
+        try:
+            with timer.stage("stream"):
+                for start in range(0, len(batch.requests), STREAM_CHUNK_SIZE):
+                    chunk = batch.requests[start:start + STREAM_CHUNK_SIZE]
+                    try:
+                        payloads = await batch_payloads(chunk, recommender, http_request.app.state, timer)
+                    except Exception as e:
+                        # Headers are already sent, so errors are reported in-band
+                        error = json.dumps(f"Recommendation error: {str(e)}")
+                        for i in range(start, start + len(chunk)):
+                            yield f'{{"index":{i},"error":{error}}}\n'.encode("utf-8")
+                        continue
+                    for i, payload in enumerate(payloads, start):
+                        yield b'{"index":' + str(i).encode() + b',"result":' + payload + b"}\n"
+            http_request.app.state.metrics.observe("/recommend/batch/stream", timer)
+        finally:
+            release()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", background=BackgroundTask(release))
+
+@app.post("/admin/reload", dependencies=[Depends(require_admin)])
+async def reload_catalog(request: Request):
+    """Load the catalog and index from disk into a new snapshot and swap it in"""
+    engine = request.app.state.engine
+    if not engine.ready:
+        raise HTTPException(status_code=503, detail=f"Recommender is {engine.status}")
+    if engine.reloading:
+        raise HTTPException(status_code=409, detail="A reload is already running")
+
+    previous = engine.recommender.version
+    if not await asyncio.to_thread(engine.reload):
+        raise HTTPException(status_code=500, detail=f"Reload failed: {engine.reload_error}")
+    return {
+        "previous_version": previous,
+        "version": engine.recommender.version,
+        "reload_seconds": round(engine.timings["reload_seconds"], 3),
+        "timestamp": get_current_timestamp()
+    }
+
+def schedule_compaction(app_state, recommender: SHLRecommender):
+    """Compact in the background once enough changes are pending"""
+    if recommender.delta.changes < COMPACT_THRESHOLD:
+        return
+    if app_state.compaction is not None and not app_state.compaction.done():
+        return
+    print(f"{recommender.delta.changes} pending catalog changes, compacting...")
+    app_state.compaction = asyncio.create_task(asyncio.to_thread(app_state.engine.compact))
+
+def change_summary(recommender: SHLRecommender) -> Dict[str, Any]:
+    return {
+        "version": recommender.version,
+        "pending_changes": recommender.delta.changes,
+        "timestamp": get_current_timestamp()
+    }
+
+@app.put("/admin/assessments", dependencies=[Depends(require_admin), Depends(get_recommender)])
+async def upsert_assessment(assessment: AssessmentUpsert, request: Request):
+    """Add or replace one assessment (matched by url, else name) without a rebuild"""
+    data = assessment.model_dump(exclude_none=True)
+    engine = request.app.state.engine
+    try:
+        recommender = await asyncio.to_thread(engine.update, ("upsert", data))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    schedule_compaction(request.app.state, recommender)
+    id_ = data.get("url") or data["name"]
+    return {"id": id_, "row": recommender.row_of(id_), **change_summary(recommender)}
+
+@app.delete("/admin/assessments", dependencies=[Depends(require_admin), Depends(get_recommender)])
+async def delete_assessment(id: str, request: Request):
+    """Remove one assessment by url (or name, for assessments without one)"""
+    engine = request.app.state.engine
+    try:
+        recommender = await asyncio.to_thread(engine.update, ("delete", id))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No assessment with id {id!r}")
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    schedule_compaction(request.app.state, recommender)
+    return {"id": id, **change_summary(recommender)}
+
+@app.post("/admin/compact", dependencies=[Depends(require_admin), Depends(get_recommender)])
+async def compact_catalog(request: Request):
+    """Merge the shared change log into a fresh catalog and index, then reload from them"""
+    engine = request.app.state.engine
+    changes = engine.recommender.delta.changes
+    if not await asyncio.to_thread(engine.compact):
+        raise HTTPException(status_code=500, detail=f"Reload after compaction failed: {engine.reload_error}")
+    return {
+        "compacted_changes": changes,
+        "compact_seconds": round(engine.timings.get("compact_seconds", 0.0), 3),
+        **change_summary(engine.recommender)
+    }
 
 @app.get("/job-levels")
-async def get_job_levels():
-    job_levels = set()
-    for assessment in MOCK_ASSESSMENTS["assessments"]:
-        job_levels.update(assessment["job_levels"])
-    return {"job_levels": sorted(job_levels)}
+async def get_job_levels(recommender: SHLRecommender = Depends(get_recommender)):
+    return {"job_levels": recommender.values("job_levels")}
 
 @app.get("/test-types")
-async def get_test_types():
-    test_types = set()
-    for assessment in MOCK_ASSESSMENTS["assessments"]:
-        test_types.add(assessment["test_type"])
-    return {"test_types": sorted(test_types)}
+async def get_test_types(recommender: SHLRecommender = Depends(get_recommender)):
+    return {"test_types": recommender.values("test_type")}
 
 if __name__ == "__main__":
     import uvicorn
@@ -24,4 +24,23 @@ class CleanRecommendationResponse(BaseModel):
     recommended_assessments: List[CleanAssessment]
     
     class Config:
-        extra = "forbid"
\ No newline at end of file
+        extra = "forbid"
+
+class BatchRecommendationRequest(BaseModel):
+    requests: List[RecommendationRequest] = Field(..., description="Queries with their own filters")
+
+class BatchRecommendationResponse(BaseModel):
+    results: List[CleanRecommendationResponse]
+
+class AssessmentUpsert(BaseModel):
+    name: str = Field(..., description="Assessment name")
+    url: Optional[str] = Field(None, description="Product page URL; identifies the assessment when set")
+    description: str = Field("", description="Assessment description")
+    job_levels: List[str] = Field(default_factory=list)
+    languages: List[str] = Field(default_factory=list)
+    duration: Optional[str] = Field(None, description="e.g. '30 minutes'")
+    remote_testing_support: bool = False
+    adaptive_irt_support: bool = False
+    pdf_link: Optional[str] = None
+    test_type: Optional[str] = None
+    metadata: Optional[Dict[str, Any]] = None
@@ -0,0 +1,61 @@
+import numpy as np
+
+
+class Int8Embeddings:
+    """
+    Symmetric int8 quantization of a unit-length embedding matrix
+
+    Each row keeps its own scale (max |value| / 127), so a row is
+    approximately `codes[i] * scales[i]`. At one byte per dimension this is a
+    quarter of the float32 footprint; scores from it are only used as a first
+    pass before exact float32 re-ranking.
+    """
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def from_matrix(cls, matrix, chunk_size=65536):
+        n, dim = matrix.shape
+        codes = np.empty((n, dim), dtype=np.int8)
+        scales = np.empty(n, dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+            block_scales = np.abs(block).max(axis=1) / 127.0
+            block_scales[block_scales == 0] = 1.0
+            codes[start:start + chunk_size] = np.rint(block / block_scales[:, None]).astype(np.int8)
+            scales[start:start + chunk_size] = block_scales
+        return cls(codes, scales)
+
+    def save(self, codes_path, scales_path):
+        for path, array in ((codes_path, self.codes), (scales_path, self.scales)):
+            with open(path, 'wb') as f:
+                np.save(f, array)
+
+    @classmethod
+    def load(cls, codes_path, scales_path):
+        """Map stored codes read-only; only the pages a query touches are read"""
+        return cls(np.load(codes_path, mmap_mode='r'), np.load(scales_path, mmap_mode='r'))
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def scores(self, query, rows=None, chunk_size=16384):
+        """
+        Approximate inner products, for all rows or a subset
+
+        `query` is one vector, giving one score per row, or a (queries x dim)
+        block, giving a (rows x queries) matrix from one product per chunk.
+        """
+        codes = self.codes if rows is None else self.codes[rows]
+        scales = self.scales if rows is None else self.scales[rows]
+        query = np.asarray(query, dtype=np.float32)
+
+        # Widen in chunks so the float32 temporaries stay small
+        out = np.empty((codes.shape[0],) + query.shape[:-1], dtype=np.float32)
+        for start in range(0, codes.shape[0], chunk_size):
+            block = codes[start:start + chunk_size].astype(np.float32)
+            out[start:start + chunk_size] = block @ query.T
+        return out * (scales if query.ndim == 1 else scales[:, None])
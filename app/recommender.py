@@ -1,85 +1,806 @@
+import copy
+import hashlib
 import json
+import math
+import os
+import time
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+from app.ann import ANN_MIN_SIZE, IVFIndex, merge_top_k, top_k
+from app.cache import LRUCache, normalize_query
+from app.catalog import Catalog
+from app.delta import CatalogDelta
+from app.embedding_builder import content_hash, embedding_text
+from app.encoders import ENCODER_BACKEND, make_encoder
+from app.facets import FacetIndex
+from app.index_store import (
+    MANIFEST_PATH,
+    MODEL_NAME,
+    IndexArtifactError,
+    assessment_id,
+    load_ann,
+    load_index,
+    load_int8,
+    load_lexical,
+    normalize_rows,
+    save_index
+)
+from app.lexical import BM25Index
+from app.quantization import Int8Embeddings
+from app.shards import SHARD_MIN_ROWS, ShardPool
+from app.shared_index import SharedArrays
+
+
+class QueryTooLongError(ValueError):
+    """Raised when a query is larger than the recommender accepts"""
+
+    def __init__(self, length, limit):
+        super().__init__(f"Query is {length} characters long; the limit is {limit}")
+        self.length = length
+        self.limit = limit
+
+
+def _without_rows(manifest):
+    """Manifest without its per-row ids and hashes, which are large and only needed for validation"""
+    return {field: value for field, value in manifest.items() if field not in ('ids', 'hashes')}
+
+
+def _id_key(id_):
+    """64-bit key of an assessment ID for the sorted ID table"""
+    return int.from_bytes(hashlib.sha256(id_.encode('utf-8')).digest()[:8], 'big')
+
 
 class SHLRecommender:
-    def __init__(self, catalog_path='data/processed/shl_assessments_detailed.json'):
-        # Load the model for creating embeddings
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    def __init__(self, catalog_path='data/processed/shl_assessments_detailed.json',
+                 manifest_path=MANIFEST_PATH, model_name=MODEL_NAME, verify_index=True,
+                 query_cache_entries=4096, query_cache_bytes=16 * 1024 * 1024,
+                 ann_nprobe=8, ann_min_size=ANN_MIN_SIZE, ann_prefilter_selectivity=0.02,
+                 embedding_mode='float32', rerank_factor=4,
+                 retrieval_mode='dense', fusion='rrf', rrf_k=60, lexical_weight=0.3,
+                 fusion_depth=50, lexical_candidates=None,
+                 max_query_chars=20000, chunk_overlap=32,
+                 encoder_backend=ENCODER_BACKEND, encoder=None, shared_dir=None,
+                 shards=0, shard_min_rows=SHARD_MIN_ROWS, shard_pool=None):
+        self.load_timings = {}
+        self.catalog_path = catalog_path
+        self.manifest_path = manifest_path
+
+        # Long job descriptions are split into model-sized token windows
+        # (overlapping by chunk_overlap tokens) instead of being truncated;
+        # max_query_chars bounds the tokenization and encoding work per query
+        self.max_query_chars = max_query_chars
+        self.chunk_overlap = chunk_overlap
+
+        # 'hybrid' fuses BM25 and cosine rankings, so exact product names and
+        # skill keywords (".NET WCF", "ADO.NET") are not lost to the embedding
+        if retrieval_mode not in ('dense', 'hybrid'):
+            raise ValueError(f"Unknown retrieval_mode {retrieval_mode!r}")
+        if fusion not in ('rrf', 'weighted'):
+            raise ValueError(f"Unknown fusion {fusion!r}")
+        self.retrieval_mode = retrieval_mode
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.lexical_weight = lexical_weight
+        self.fusion_depth = fusion_depth
+        # When set, only the best `lexical_candidates` BM25 rows are dense-scored
+        self.lexical_candidates = lexical_candidates
+
+        # 'int8' keeps a quantized copy for a first-pass score and re-ranks
+        # the best rerank_factor * k candidates against the float32 matrix
+        if embedding_mode not in ('float32', 'int8'):
+            raise ValueError(f"Unknown embedding_mode {embedding_mode!r}")
+        self.embedding_mode = embedding_mode
+        self.rerank_factor = rerank_factor
+
+        # ANN knobs: lists probed per query (recall vs latency), the catalog
+        # size below which search stays exact, and the filter selectivity
+        # below which filtered rows are scored exactly instead of via ANN
+        self.ann_nprobe = ann_nprobe
+        self.ann_min_size = ann_min_size
+        self.ann_prefilter_selectivity = ann_prefilter_selectivity
+
+        # With shards > 1, exact passes over at least shard_min_rows rows are
+        # split into row ranges scored by that many worker processes
+        self.shard_min_rows = shard_min_rows
+
+        # Query embeddings keyed by normalized query text
+        self.query_cache = LRUCache(max_entries=query_cache_entries, max_bytes=query_cache_bytes)
+
+        # Load the query encoder (sentence-transformers, ONNX Runtime or the hash stub)
+        start = time.perf_counter()
+        self.encoder = encoder or make_encoder(encoder_backend, model_name)
+        self.load_timings['model_seconds'] = time.perf_counter() - start
         
-        # Load and process catalog data from the detailed file
-        with open(catalog_path, 'r', encoding='utf-8') as f:
-            self.catalog_data = json.load(f)
+        # Load the detailed catalog and keep only its typed columnar form
+        start = time.perf_counter()
+        with open(catalog_path, 'rb') as f:
+            raw = f.read()
+        # Checksum the bytes that were parsed, even if the file changes afterwards
+        self.catalog_checksum = hashlib.sha256(raw).hexdigest()
+        self.catalog = Catalog(json.loads(raw))
+        self.load_timings['catalog_seconds'] = time.perf_counter() - start
         
-        # Process embeddings (generate if not already present)
-        self.process_embeddings(catalog_path)
+        # Attach the prebuilt index read-only; encoding happens in app.build_index
+        start = time.perf_counter()
+        if shared_dir:
+            self._attach_shared(shared_dir, manifest_path, verify_index)
+        else:
+            self._load_index(manifest_path, self.encoder.index_name, verify_index)
+            self._load_ann(manifest_path)
+            self.quantized = None
+            if embedding_mode == 'int8':
+                self.quantized = self._load_quantized(manifest_path, verify_index)
+            self.facets = FacetIndex(self.catalog)
+            self._id_keys, self._id_rows = self._id_table()
+        self.load_timings['index_seconds'] = time.perf_counter() - start
+
+        # Shard workers map the index file themselves; a reload passes the running pool on
+        self.shard_pool = None
+        if shards > 1:
+            start = time.perf_counter()
+            self.shard_pool = shard_pool or ShardPool(shards)
+            self._embeddings_path = os.path.join(os.path.dirname(manifest_path), self._manifest['embeddings_file'])
+            self._catalog_rows = None
+            if self._realigned_rows is not None:
+                # Shards are row ranges of the file, which is in manifest order
+                self._catalog_rows = np.full(self._manifest['count'], -1, dtype=np.int64)
+                self._catalog_rows[self._realigned_rows] = np.arange(self._realigned_rows.size)
+            self.shard_pool.warm(self._embeddings_path, self._manifest['count'])
+            self.load_timings['shards_seconds'] = time.perf_counter() - start
+
+        # Identifies this catalog + index snapshot; cached results are keyed on it
+        self.base_version = f"{self.index_version}-{self.catalog_checksum[:12]}"
+        self.version = self.base_version
+
+        # Admin changes since the last compaction, layered over the base rows
+        self.delta = CatalogDelta(len(self.catalog), self.embedding_matrix.shape[1], self.catalog.metadata)
+
+        # Inverted index over name + description, the same text that is embedded
+        if not shared_dir:
+            start = time.perf_counter()
+            self.lexical = self._load_lexical(manifest_path, verify_index)
+            self.load_timings['lexical_seconds'] = time.perf_counter() - start
     
-    def process_embeddings(self, catalog_path):
-        """Process catalog data and create embeddings if they don't exist"""
-        if 'embeddings' not in self.catalog_data:
-            print("Generating embeddings for assessments...")
-            assessments = self.catalog_data.get('assessments', [])
-            
-            # Create description embeddings by combining name and description
-            for assessment in assessments:
-                rich_text = f"{assessment.get('name', '')} {assessment.get('description', '')}"
-                assessment['embedding'] = self.model.encode(rich_text).tolist()
-            
-            self.catalog_data['embeddings'] = True
-            
-            # Save back the enriched data
-            with open(catalog_path, 'w', encoding='utf-8') as f:
-                json.dump(self.catalog_data, f, indent=2)
+    def warm_up(self):
+        """Run one full query so first-call costs are paid before serving"""
+        start = time.perf_counter()
+        self.get_recommendations("warm-up query for the assessment recommender", top_n=1)
+        self.load_timings['warmup_seconds'] = time.perf_counter() - start
     
+    def _load_index(self, manifest_path, model_name, verify_index=True):
+        """Attach the pre-normalized float32 embedding matrix for scoring"""
+        matrix, manifest = load_index(manifest_path, verify=verify_index)
+        # The per-row ids and hashes are only needed to validate the index
+        self._manifest = _without_rows(manifest)
+        self._realigned_rows = None
+        if manifest['model'] != model_name:
+            raise IndexArtifactError(
+                f"Index was built with {manifest['model']}, not {model_name}; "
+                "run `python -m app.build_index`"
+            )
+
+        assessments = list(self.catalog.records())
+        ids = [assessment_id(a) for a in assessments]
+        hashes = [content_hash(embedding_text(a)) for a in assessments]
+        if manifest['ids'] == ids and manifest['hashes'] == hashes:
+            # Same order as the catalog: score straight off the memmap
+            self.index_version = manifest['version']
+            self.has_embedding = np.ones(len(ids), dtype=bool)
+            self.embedding_matrix = matrix
+            return
+
+        # Never encode at serve time: a stale index is a deployment error
+        row_of = {id_: row for row, id_ in enumerate(manifest['ids'])}
+        stale = [id_ for id_, hash_ in zip(ids, hashes)
+                 if id_ not in row_of or manifest['hashes'][row_of[id_]] != hash_]
+        if stale:
+            raise IndexArtifactError(
+                f"Index {manifest['version']} is out of date for {len(stale)} assessments; "
+                "run `python -m app.build_index`"
+            )
+
+        # Same content in a different order: gather rows by ID
+        print("Embedding manifest does not match catalog order, realigning rows...")
+        rows = np.array([row_of[id_] for id_ in ids], dtype=np.int64)
+        self._realigned_rows = rows
+        self.index_version = manifest['version']
+        self.has_embedding = np.ones(len(ids), dtype=bool)
+        self.embedding_matrix = np.ascontiguousarray(matrix[rows])
+
+    def _id_table(self):
+        """
+        ID -> row lookup as two flat arrays instead of a dict
+
+        `id_keys` holds the sorted 64-bit keys of the catalog's IDs and
+        `id_rows` their rows, so workers can share the table; a lookup
+        compares the catalog's own ID at each row with a matching key.
+        """
+        keys = np.fromiter((_id_key(url or name or '') for url, name in zip(self.catalog.urls, self.catalog.names)),
+                           dtype=np.uint64, count=len(self.catalog))
+        rows = np.argsort(keys, kind='stable')
+        return keys[rows], rows
+
+    def _base_row(self, id_):
+        """Base row of an assessment ID, tombstoned or not, or None"""
+        key = np.uint64(_id_key(id_))
+        start = int(np.searchsorted(self._id_keys, key, side='left'))
+        end = int(np.searchsorted(self._id_keys, key, side='right'))
+        # Like a dict built in row order, a duplicated ID resolves to its last row
+        for row in reversed(self._id_rows[start:end].tolist()):
+            if (self.catalog.urls[row] or self.catalog.names[row] or '') == id_:
+                return row
+        return None
+
+    def _load_ann(self, manifest_path):
+        """IVF index stored with the manifest, with its lists pointing at catalog rows"""
+        self.ann_index = load_ann(self._manifest, manifest_path)
+        if self.ann_index is not None and self._realigned_rows is not None:
+            # ANN lists point at artifact rows; translate them to catalog rows
+            catalog_row = np.empty_like(self._realigned_rows)
+            catalog_row[self._realigned_rows] = np.arange(self._realigned_rows.size)
+            self.ann_index.rows = catalog_row[self.ann_index.rows]
+
+    def _load_quantized(self, manifest_path, verify_index=True):
+        """int8 codes stored with the index, in catalog row order"""
+        quantized = load_int8(self._manifest, manifest_path, verify=verify_index)
+        if quantized is None:
+            print("Index has no stored int8 codes, quantizing at load; rebuild it to store them")
+            return Int8Embeddings.from_matrix(self.embedding_matrix)
+        if self._realigned_rows is not None:
+            quantized = Int8Embeddings(quantized.codes[self._realigned_rows], quantized.scales[self._realigned_rows])
+        return quantized
+
+    def _load_lexical(self, manifest_path, verify_index=True):
+        """BM25 postings stored with the index, in catalog row order"""
+        lexical = load_lexical(self._manifest, manifest_path, verify=verify_index)
+        if lexical is None:
+            print("Index has no stored BM25 postings, indexing the catalog at load; rebuild it to store them")
+            return BM25Index.build(embedding_text(a) for a in self.catalog.records())
+        if self._realigned_rows is not None:
+            lexical = lexical.select(self._realigned_rows)
+        return lexical
+
+    def _attach_shared(self, shared_dir, manifest_path, verify_index=True):
+        """
+        Map the index-derived arrays from a directory shared by all workers
+
+        The first worker validates the index and publishes the realigned
+        matrix, int8 codes and BM25 postings (if the order differs), ANN
+        lists, facet masks and the ID table; later workers map them read-only
+        instead of building their own copies. No worker keeps the manifest's
+        per-row ids and hashes once it has loaded.
+        """
+        matrix, manifest = load_index(manifest_path, verify=False)
+        if manifest['model'] != self.encoder.index_name:
+            raise IndexArtifactError(
+                f"Index was built with {manifest['model']}, not {self.encoder.index_name}; "
+                "run `python -m app.build_index`"
+            )
+
+        def build():
+            self._load_index(manifest_path, self.encoder.index_name, verify_index)
+            self._load_ann(manifest_path)
+            arrays = FacetIndex(self.catalog).to_arrays()
+            arrays.update(zip(('id_keys', 'id_rows'), self._id_table()))
+            if self._realigned_rows is not None:
+                arrays['embeddings'] = self.embedding_matrix
+                arrays['artifact_rows'] = self._realigned_rows
+            if self.ann_index is not None:
+                arrays.update(ann_centroids=self.ann_index.centroids, ann_offsets=self.ann_index.offsets,
+                              ann_rows=self.ann_index.rows)
+            # Stored codes in catalog order are mapped straight from the index
+            if self.embedding_mode == 'int8' and (self._realigned_rows is not None
+                                                  or not manifest.get('int8_file')):
+                quantized = self._load_quantized(manifest_path, verify_index)
+                arrays.update(int8_codes=quantized.codes, int8_scales=quantized.scales)
+            # So are stored BM25 postings in catalog order
+            if self._realigned_rows is not None or not manifest.get('lexical_files'):
+                arrays.update(self._load_lexical(manifest_path, verify_index).to_arrays())
+            return arrays
+
+        # The key changes with the index, the catalog (facets, IDs), the mode and the set of arrays
+        key = f"{manifest['version']}-{self.catalog_checksum[:16]}-{self.embedding_mode}-2"
+        arrays, built = SharedArrays(shared_dir, key).attach(build)
+        print(f"{'Published' if built else 'Attached'} shared index {key} in {shared_dir}")
+
+        self._manifest = _without_rows(manifest)
+        self.index_version = manifest['version']
+        self.has_embedding = np.ones(len(self.catalog), dtype=bool)
+        self.embedding_matrix = arrays.get('embeddings', matrix)
+        self._realigned_rows = arrays.get('artifact_rows')
+        self.ann_index = None
+        if 'ann_rows' in arrays:
+            self.ann_index = IVFIndex(arrays['ann_centroids'], arrays['ann_offsets'], arrays['ann_rows'])
+        self.quantized = None
+        if 'int8_codes' in arrays:
+            self.quantized = Int8Embeddings(arrays['int8_codes'], arrays['int8_scales'])
+        elif self.embedding_mode == 'int8':
+            self.quantized = self._load_quantized(manifest_path, verify_index=False)
+        self.facets = FacetIndex.from_arrays(arrays)
+        self._id_keys, self._id_rows = arrays['id_keys'], arrays['id_rows']
+        if 'lexical_offsets' in arrays:
+            self.lexical = BM25Index.from_arrays(arrays)
+        else:
+            self.lexical = self._load_lexical(manifest_path, verify_index=False)
+
+    def _filter_mask(self, job_level=None, duration_max=None, languages=None, test_type=None):
+        """Boolean row mask of assessments that pass the given filters"""
+        mask = self.facets.mask(job_level, duration_max, languages, test_type) & self.has_embedding
+        if len(self.delta):
+            mask = np.concatenate([mask, self.delta.mask(job_level, duration_max, languages, test_type)])
+        if self.delta.deleted.size:
+            mask[self.delta.deleted] = False
+        return mask
+
+    def _vectors(self, rows):
+        """Embedding rows for base and appended rows alike"""
+        n = self.delta.base_size
+        appended = rows >= n
+        if not appended.any():
+            if rows.size == self.embedding_matrix.shape[0]:
+                return self.embedding_matrix
+            return self.embedding_matrix[rows]
+
+        vectors = np.empty((rows.size, self.embedding_matrix.shape[1]), dtype=np.float32)
+        vectors[~appended] = self.embedding_matrix[rows[~appended]]
+        vectors[appended] = self.delta.embeddings[rows[appended] - n]
+        return vectors
+
+    def _sharded_search(self, query_embeddings, rows, k):
+        """Top-k per query over the given rows, base rows scattered across the shard processes"""
+        n = self.delta.base_size
+        appended = rows[rows >= n]
+        rows = rows[rows < n]
+
+        n_rows = self._manifest['count']
+        mask = None
+        if rows.size < n_rows:
+            mask = np.zeros(n_rows, dtype=bool)
+            mask[rows if self._realigned_rows is None else self._realigned_rows[rows]] = True
+        results = self.shard_pool.search(self._embeddings_path, n_rows, query_embeddings, k, mask)
+        if self._catalog_rows is not None:
+            results = [(self._catalog_rows[r], s) for r, s in results]
+
+        if appended.size:
+            # Appended rows aren't in the index file: score them here and merge
+            scores = self.delta.embeddings[appended - n] @ query_embeddings.T
+            results = [merge_top_k([result, (appended, scores[:, j])], k) for j, result in enumerate(results)]
+        return results
+
+    def _exact_search(self, query_embedding, rows, k):
+        """Score the given rows with one matrix-vector product and keep the top k"""
+        if self.shard_pool is not None and rows.size >= self.shard_min_rows:
+            return self._sharded_search(query_embedding[None, :], rows, k)[0]
+
+        n = self.delta.base_size
+        if rows.size and rows[-1] >= n:
+            # Appended rows have no int8 codes: score them exactly and merge
+            appended = rows[rows >= n]
+            return merge_top_k([
+                self._exact_search(query_embedding, rows[rows < n], k),
+                (appended, self.delta.embeddings[appended - n] @ query_embedding)
+            ], k)
+
+        if self.quantized is not None and rows.size > k * self.rerank_factor:
+            # Cheap int8 first pass, then exact float32 scores for the survivors
+            all_rows = rows.size == self.quantized.codes.shape[0]
+            approx = self.quantized.scores(query_embedding, None if all_rows else rows)
+            rows = np.sort(rows[top_k(approx, k * self.rerank_factor)])
+
+        # Cosine similarity is a single matrix-vector product on unit vectors
+        if rows.size == self.embedding_matrix.shape[0]:
+            scores = self.embedding_matrix @ query_embedding
+        else:
+            scores = self.embedding_matrix[rows] @ query_embedding
+
+        # Partial selection of the top k, then order just those
+        top = top_k(scores, k)
+        return rows[top], scores[top]
+
+    def _search(self, query_embedding, mask, k):
+        """Top-k rows passing the filter mask, via ANN when it pays off"""
+        n = self.delta.base_size
+        if mask.size > n:
+            # Appended rows aren't in the ANN lists: search the base, then merge them in
+            appended = n + np.flatnonzero(mask[n:])
+            base = self._search(query_embedding, mask[:n], k)
+            if appended.size == 0:
+                return base
+            return merge_top_k([base, (appended, self.delta.embeddings[appended - n] @ query_embedding)], k)
+
+        selected = int(np.count_nonzero(mask))
+        if selected == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        if self.ann_index is not None and mask.size >= self.ann_min_size:
+            # Over-fetch: probe proportionally more lists so enough rows survive the filter
+            selectivity = selected / mask.size
+            nprobe = math.ceil(self.ann_nprobe / selectivity)
+            if selectivity >= self.ann_prefilter_selectivity and nprobe < self.ann_index.n_lists:
+                rows, scores = self.ann_index.search(
+                    self.embedding_matrix, query_embedding, k, nprobe,
+                    mask=None if selected == mask.size else mask
+                )
+                if rows.size >= min(k, selected):
+                    return rows, scores
+            # Selective filters (or an under-filled ANN result): pre-filter, then exact search
+
+        return self._exact_search(query_embedding, np.flatnonzero(mask), k)
+
+    def _dense_search(self, query, query_embedding, mask, k):
+        """Cosine top-k, dense-scoring only BM25 candidates when lexical_candidates is set"""
+        if self.lexical_candidates and query:
+            rows, _ = self.lexical.search(query, max(k, self.lexical_candidates), mask)
+            # Too few keyword matches to fill the result: fall back to full dense search
+            if rows.size >= k:
+                return self._exact_search(query_embedding, np.sort(rows), k)
+        return self._search(query_embedding, mask, k)
+
+    def _fuse(self, query_embedding, dense, lexical, k):
+        """Merge dense and BM25 rankings; returned scores stay cosine similarities"""
+        fused = {}
+        if self.fusion == 'rrf':
+            # Reciprocal rank fusion: only ranks matter, so score scales don't need tuning
+            for rows, _ in (dense, lexical):
+                for rank, row in enumerate(rows.tolist()):
+                    fused[row] = fused.get(row, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        else:
+            # Weighted sum of cosine and max-normalized BM25
+            dense_rows, dense_scores = dense
+            lexical_rows, lexical_scores = lexical
+            top_lexical = float(lexical_scores[0]) if lexical_scores.size else 1.0
+            for row, score in zip(dense_rows.tolist(), dense_scores.tolist()):
+                fused[row] = (1.0 - self.lexical_weight) * score
+            for row, score in zip(lexical_rows.tolist(), lexical_scores.tolist()):
+                fused[row] = fused.get(row, 0.0) + self.lexical_weight * score / top_lexical
+
+        ranked = sorted(fused, key=fused.get, reverse=True)[:k]
+        rows = np.array(ranked, dtype=np.int64)
+        if rows.size == 0:
+            return rows, np.zeros(0, dtype=np.float32)
+        return rows, np.asarray(self._vectors(rows) @ query_embedding, dtype=np.float32)
+
+    def _retrieve(self, query, query_embedding, mask, k, dense=None):
+        """
+        Top-k rows for one query under the configured retrieval mode
+
+        `dense` may carry the query's dense top-max(k, fusion_depth) rows when
+        they were already scored together with other queries.
+        """
+        if self.retrieval_mode == 'dense' or not query:
+            if dense is not None:
+                return dense[0][:k], dense[1][:k]
+            return self._dense_search(query, query_embedding, mask, k)
+
+        depth = max(k, self.fusion_depth)
+        lexical = self.lexical.search(query, depth, mask)
+        if lexical[0].size == 0:
+            if dense is not None:
+                return dense[0][:k], dense[1][:k]
+            return self._dense_search(query, query_embedding, mask, k)
+        if dense is None:
+            dense = self._dense_search(query, query_embedding, mask, depth)
+        return self._fuse(query_embedding, dense, lexical, k)
+
+    def _batch_search(self, query_embeddings, mask, k, max_scores=16 * 1024 * 1024):
+        """Top-k rows for many queries under one mask, with one matrix-matrix product per chunk"""
+        if self.ann_index is not None and self.delta.base_size >= self.ann_min_size:
+            return [self._search(q, mask, k) for q in query_embeddings]
+
+        rows = np.flatnonzero(mask)
+        if rows.size == 0 or k <= 0:
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+            return [empty for _ in range(len(query_embeddings))]
+
+        if self.shard_pool is not None and rows.size >= self.shard_min_rows:
+            return self._sharded_search(query_embeddings, rows, k)
+
+        n = self.delta.base_size
+        base = rows[rows < n]
+        if self.quantized is not None and base.size > k * self.rerank_factor:
+            results = self._batch_rerank(query_embeddings, base, k, max_scores)
+            appended = rows[rows >= n]
+            if appended.size:
+                # Appended rows have no int8 codes: score them exactly and merge, as _search does
+                scores = self.delta.embeddings[appended - n] @ query_embeddings.T
+                results = [merge_top_k([result, (appended, scores[:, j])], k) for j, result in enumerate(results)]
+            return results
+
+        matrix = self._vectors(rows)
+        k = min(k, rows.size)
+
+        # Chunk the queries so the (rows x queries) score block stays bounded
+        results = []
+        chunk = max(1, max_scores // rows.size)
+        for start in range(0, len(query_embeddings), chunk):
+            scores = matrix @ query_embeddings[start:start + chunk].T
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            for j in range(scores.shape[1]):
+                column = top[:, j][np.argsort(-scores[top[:, j], j], kind='stable')]
+                results.append((rows[column], scores[column, j]))
+        return results
+
+    def _batch_rerank(self, query_embeddings, rows, k, max_scores):
+        """
+        int8 first pass for many queries at once, then float32 re-ranking per query
+
+        The codes are scored with one matrix-matrix product per chunk of
+        queries; only each query's k * rerank_factor survivors are read from
+        the float32 matrix, exactly as `_exact_search` does for one query.
+        """
+        all_rows = rows.size == self.quantized.codes.shape[0]
+        results = []
+        chunk = max(1, max_scores // rows.size)
+        for start in range(0, len(query_embeddings), chunk):
+            block = query_embeddings[start:start + chunk]
+            approx = self.quantized.scores(block, None if all_rows else rows)
+            for j, query_embedding in enumerate(block):
+                survivors = np.sort(rows[top_k(approx[:, j], k * self.rerank_factor)])
+                scores = self.embedding_matrix[survivors] @ query_embedding
+                top = top_k(scores, k)
+                results.append((survivors[top], scores[top]))
+        return results
+
+    def validate_query(self, query):
+        """Raise QueryTooLongError for queries over max_query_chars"""
+        if self.max_query_chars and len(query) > self.max_query_chars:
+            raise QueryTooLongError(len(query), self.max_query_chars)
+
+    def _query_chunks(self, text):
+        """Split text into pieces that each fit the model's sequence length"""
+        window = max(16, (getattr(self.encoder, 'max_seq_length', None) or 256) - 2)
+        # Fewer characters than the window means fewer tokens: skip tokenization
+        if len(text) <= window:
+            return [text]
+
+        tokenizer = getattr(self.encoder, 'tokenizer', None)
+        if tokenizer is not None:
+            pieces, join = tokenizer.tokenize(text), tokenizer.convert_tokens_to_string
+        else:
+            # No tokenizer exposed: approximate with words (~4 tokens per 3 words)
+            window = window * 3 // 4
+            pieces, join = text.split(), ' '.join
+        if len(pieces) <= window:
+            return [text]
+
+        step = max(1, window - min(self.chunk_overlap, window // 2))
+        return [join(pieces[start:start + window])
+                for start in range(0, max(1, len(pieces) - window + step), step)]
+
+    def _encode_texts(self, texts):
+        """Unit-length vectors for texts, mean-pooling the chunks of long ones"""
+        chunks = [self._query_chunks(text) for text in texts]
+        flat = [chunk for text_chunks in chunks for chunk in text_chunks]
+        # All chunks of all texts go through the model in one call
+        encoded = normalize_rows(np.asarray(self.encoder.encode(flat)).reshape(len(flat), -1))
+        if len(flat) == len(texts):
+            return encoded
+
+        pooled, start = np.empty((len(texts), encoded.shape[1]), dtype=np.float32), 0
+        for i, text_chunks in enumerate(chunks):
+            pooled[i] = encoded[start:start + len(text_chunks)].mean(axis=0)
+            start += len(text_chunks)
+        return normalize_rows(pooled)
+
+    def encode_queries(self, queries):
+        """Encode a batch of queries into unit-length float32 vectors, using the cache"""
+        for query in queries:
+            self.validate_query(query)
+        keys = [normalize_query(q) for q in queries]
+        vectors = {key: self.query_cache.get(key) for key in dict.fromkeys(keys)}
+
+        # Only cache misses go through the model, each distinct text once
+        missing = [key for key, vector in vectors.items() if vector is None]
+        if missing:
+            encoded = self._encode_texts(missing)
+            for key, vector in zip(missing, encoded):
+                # Own copy so the cache doesn't pin the whole batch array
+                vector = vector.copy()
+                vector.setflags(write=False)
+                vectors[key] = vector
+                self.query_cache.put(key, vector)
+
+        if not keys:
+            return np.zeros((0, self.embedding_matrix.shape[1]), dtype=np.float32)
+        return np.stack([vectors[key] for key in keys])
+
     def get_recommendations(self, query, job_level=None, duration_max=None, 
-                            languages=None, test_type=None, top_n=5):
-        """Get recommendations based on query and optional filters"""
-        query_embedding = self.model.encode(query)
-        filtered_assessments = []
-
-        for assessment in self.catalog_data.get('assessments', []):
-            # Defensive checks for optional fields
-            if job_level and job_level not in (assessment.get('job_levels') or []):
-                continue
-
-            if duration_max is not None:
-                duration_mins = self._parse_duration(assessment.get('duration', '0 minutes'))
-                if duration_mins > duration_max:
-                    continue
+                            languages=None, test_type=None, top_n=5, query_embedding=None,
+                            timings=None):
+        """
+        Get recommendations based on query and optional filters
 
-            if languages and not any(lang in (assessment.get('languages') or []) for lang in languages):
-                continue
+        When a `timings` dict is given, the seconds spent in each stage
+        ('encode', 'filter', 'score', 'records') are written into it.
+        """
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        if query_embedding is None:
+            query_embedding = self.encode_queries([query])[0]
+            timings['encode'] = time.perf_counter() - start
+            start = time.perf_counter()
 
-            if test_type and test_type != assessment.get('test_type'):
-                continue
+        mask = self._filter_mask(job_level, duration_max, languages, test_type)
+        timings['filter'] = time.perf_counter() - start
+        if top_n <= 0:
+            return []
+        start = time.perf_counter()
+        rows, scores = self._retrieve(query, query_embedding, mask, top_n)
+        timings['score'] = time.perf_counter() - start
 
-            # Skip if embedding is missing or malformed
-            embedding = assessment.get('embedding')
-            if embedding is None:
-                continue
+        start = time.perf_counter()
+        results = [
+            {
+                'assessment': self.record(row),
+                'similarity': float(score)
+            }
+            for row, score in zip(rows, scores)
+        ]
+        timings['records'] = time.perf_counter() - start
+        return results
 
-            sim_score = cosine_similarity(
-                [query_embedding],
-                [embedding]
-            )[0][0]
+    def get_recommendations_batch(self, queries, job_level=None, duration_max=None,
+                                  languages=None, test_type=None, top_n=5, query_embeddings=None,
+                                  timings=None):
+        """Get recommendations for many queries that share the same filters (timings as above)"""
+        timings = {} if timings is None else timings
+        start = time.perf_counter()
+        if query_embeddings is None:
+            query_embeddings = self.encode_queries(queries)
+            timings['encode'] = time.perf_counter() - start
+            start = time.perf_counter()
 
-            filtered_assessments.append({
-                'assessment': assessment,
-                'similarity': float(sim_score)
-            })
+        mask = self._filter_mask(job_level, duration_max, languages, test_type)
+        timings['filter'] = time.perf_counter() - start
+        if top_n <= 0:
+            return [[] for _ in range(len(query_embeddings))]
 
-        filtered_assessments.sort(key=lambda x: x['similarity'], reverse=True)
-        return filtered_assessments[:top_n]
-    
-    def _parse_duration(self, duration_str):
-        if not duration_str:
-            return 0
-        try:
-            minutes = int(''.join(filter(str.isdigit, duration_str)))
-            return minutes
-        except ValueError:
-            return 0
+        start = time.perf_counter()
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        if self.lexical_candidates:
+            # Dense scoring is restricted to each query's own BM25 candidates
+            results = [self._retrieve(query, q, mask, top_n) for query, q in zip(queries, query_embeddings)]
+        elif self.retrieval_mode == 'dense':
+            results = self._batch_search(query_embeddings, mask, top_n)
+        else:
+            # Dense candidates for every query in one matrix-matrix product;
+            # only BM25 scoring and fusion run per query
+            dense = self._batch_search(query_embeddings, mask, max(top_n, self.fusion_depth))
+            results = [self._retrieve(query, q, mask, top_n, dense=d)
+                       for query, q, d in zip(queries, query_embeddings, dense)]
+        timings['score'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = [
+            [
+                {
+                    'assessment': self.record(row),
+                    'similarity': float(score)
+                }
+                for row, score in zip(rows, scores)
+            ]
+            for rows, scores in results
+        ]
+        timings['records'] = time.perf_counter() - start
+        return results
+
+    def record(self, row):
+        """Plain dict for one row, whether it is a base or an appended row"""
+        n = self.delta.base_size
+        return self.catalog.record(row) if row < n else self.delta.record(row - n)
+
+    def records(self):
+        """Live assessments: base rows that aren't tombstoned, then appended ones"""
+        for row in range(self.delta.size):
+            if not self.delta.is_deleted(row):
+                yield self.record(row)
+
+    def catalog_dict(self):
+        """The live catalog in its JSON shape"""
+        return {'metadata': dict(self.catalog.metadata), 'assessments': list(self.records())}
+
+    def values(self, field):
+        """Sorted distinct values of 'job_levels', 'languages' or 'test_type'"""
+        return sorted(set(self.catalog.values(field)) | self.delta.values(field))
+
+    def row_of(self, id_):
+        """Current row of an assessment ID (url, else name), or None"""
+        row = self.delta.row_of(id_)
+        if row is None:
+            row = self._base_row(id_)
+            if row is not None and self.delta.is_deleted(row):
+                row = None
+        return row
+
+    def _with_delta(self, delta, lexical):
+        # Shallow copy: every heavy structure is shared with this snapshot
+        snapshot = copy.copy(self)
+        snapshot.delta = delta
+        snapshot.lexical = lexical
+        snapshot.version = f"{self.base_version}+{delta.digest[:12]}"
+        return snapshot
+
+    def upsert(self, assessment):
+        """
+        New snapshot with one assessment added or replaced
+
+        Only this assessment is encoded; it is appended to the delta segment
+        and the new snapshot's BM25 index, and the row it replaces is
+        tombstoned. The current snapshot is left untouched for requests still
+        using it.
+        """
+        return self._apply([('upsert', assessment)])
+
+    def delete(self, id_):
+        """New snapshot without the assessment; raises KeyError if it isn't there"""
+        if self.row_of(id_) is None:
+            raise KeyError(id_)
+        return self._apply([('delete', id_)])
+
+    def replay(self, operations):
+        """Re-apply delta operations (e.g. to a freshly reloaded snapshot)"""
+        return self._apply(operations)
+
+    def _apply(self, operations):
+        """
+        New snapshot with the operations applied in order
+
+        Each step derives a delta and a BM25 index that append to the
+        structures they share with the previous step's, so a change costs
+        O(changed items) and this snapshot is never changed; deletes of
+        assessments that aren't there are skipped.
+        """
+        snapshot = self
+        for operation, value in operations:
+            lexical = snapshot.lexical.copy()
+            if operation == 'upsert':
+                id_ = assessment_id(value)
+                if not id_:
+                    raise ValueError("An assessment needs a url or a name")
+                text = embedding_text(value)
+                embedding = self._encode_texts([text])[0]
+                replaced = snapshot.row_of(id_)
+                delta = snapshot.delta.upsert(value, embedding, replaced)
+                if replaced is not None:
+                    lexical.remove(replaced, embedding_text(snapshot.record(replaced)))
+                lexical.add(delta.size - 1, text)
+            else:
+                row = snapshot.row_of(value)
+                if row is None:
+                    continue
+                lexical.remove(row, embedding_text(snapshot.record(row)))
+                delta = snapshot.delta.delete(row, value)
+            snapshot = snapshot._with_delta(delta, lexical)
+        return snapshot
+
+    def compact(self):
+        """
+        Write the live catalog and its embeddings as fresh artifacts
+
+        This costs O(catalog) and is meant to run now and then, not per
+        change; reload afterwards to serve from the new files.
+        """
+        live = np.ones(self.delta.size, dtype=bool)
+        live[:self.delta.base_size] &= self.has_embedding
+        live[self.delta.deleted] = False
+        rows = np.flatnonzero(live)
+
+        records = [self.record(row) for row in rows]
+        ids = [assessment_id(a) for a in records]
+        hashes = [content_hash(embedding_text(a)) for a in records]
+        matrix = np.asarray(self._vectors(rows), dtype=np.float32)
+        ann = None
+        if self.ann_index is not None or rows.size >= ANN_MIN_SIZE:
+            ann = IVFIndex.build(matrix)
+
+        # Index first: until the catalog follows, a reload sees a mismatch and keeps the old snapshot
+        manifest = save_index(matrix, ids, hashes, self.encoder.index_name, self.manifest_path, ann=ann,
+                              lexical=self.lexical.select(rows))
+        with open(self.catalog_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'metadata': dict(self.catalog.metadata), 'assessments': records}, f, indent=2)
+        os.replace(self.catalog_path + '.tmp', self.catalog_path)
+        print(f"Compacted {self.delta.changes} changes into index {manifest['version']} "
+              f"({manifest['count']} assessments)")
+        return manifest
 
 # ---------------- Test the recommender ---------------- #
 if __name__ == "__main__":
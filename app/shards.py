@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from app.ann import merge_top_k, top_k
+
+# Below this many rows one process beats the scatter-gather round trip
+SHARD_MIN_ROWS = 200000
+
+# The pool provides the parallelism, so each worker runs single-threaded BLAS
+_WORKER_ENV = {'OMP_NUM_THREADS': '1', 'OPENBLAS_NUM_THREADS': '1', 'MKL_NUM_THREADS': '1'}
+
+# Worker-process state: memmapped matrices by path
+_matrices = {}
+
+
+def _open(path):
+    matrix = _matrices.get(path)
+    if matrix is None:
+        # Keep the serving and the reloading snapshot's matrices mapped, no more
+        while len(_matrices) >= 2:
+            _matrices.pop(next(iter(_matrices)))
+        matrix = _matrices[path] = np.load(path, mmap_mode='r')
+    return matrix
+
+
+def _warm(path, start, end):
+    """Map the matrix and fault a shard's pages in"""
+    return float(np.asarray(_open(path)[start:end]).sum())
+
+
+def _score_shard(path, start, end, queries, packed_mask, k, max_scores=16 * 1024 * 1024):
+    """Local top-k (rows, scores) per query over rows start..end-1 of the matrix"""
+    block = _open(path)[start:end]
+    rows = None
+    if packed_mask is not None:
+        rows = np.flatnonzero(np.unpackbits(packed_mask, count=end - start))
+        block = block[rows]
+
+    results = []
+    chunk = max(1, max_scores // max(1, block.shape[0]))
+    for first in range(0, queries.shape[0], chunk):
+        scores = np.asarray(block @ queries[first:first + chunk].T)
+        for j in range(scores.shape[1]):
+            top = top_k(scores[:, j], k)
+            results.append(((top if rows is None else rows[top]) + start, scores[top, j]))
+    return results
+
+
+class ShardPool:
+    """
+    Scatter-gather exact top-k over row-range shards of a memmapped matrix
+
+    Each shard is a contiguous range of rows of the on-disk .npy matrix and
+    is scored by a worker process that maps the file itself, so the pages
+    are shared through the page cache instead of being copied per process.
+    Every shard returns its local top-k under the same row mask and the
+    coordinator keeps the best k of those. Tasks name the matrix file they
+    score, so one pool serves successive catalog snapshots.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is not None:
+                return self._executor
+            saved = {key: os.environ.get(key) for key in _WORKER_ENV}
+            os.environ.update(_WORKER_ENV)
+            try:
+                # Spawned, not forked: the server process runs threads
+                executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+                # Start every worker now, while the environment caps their BLAS threads
+                for future in [executor.submit(os.getpid) for _ in range(self.processes)]:
+                    future.result()
+            finally:
+                for key, value in saved.items():
+                    if value is None:
+                        os.environ.pop(key, None)
+                    else:
+                        os.environ[key] = value
+            self._executor = executor
+            return executor
+
+    def shards(self, n_rows):
+        """Row ranges, one per worker process"""
+        bounds = np.linspace(0, n_rows, self.processes + 1).astype(np.int64)
+        return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+    def warm(self, path, n_rows):
+        """Start the workers and map the matrix before the first query"""
+        executor = self._start()
+        for future in [executor.submit(_warm, path, start, end) for start, end in self.shards(n_rows)]:
+            future.result()
+
+    def search(self, path, n_rows, queries, k, mask=None):
+        """
+        Top-k rows per query over the matrix at `path`
+
+        Args:
+            path: .npy file of the unit-length embedding matrix
+            n_rows: Rows in that matrix
+            queries: (n_queries, dim) float32 query embeddings
+            k: Results per query
+            mask: Optional boolean row mask; rows outside it are never returned
+
+        Returns:
+            One (rows, scores) pair per query, best first
+        """
+        executor = self._start()
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        futures = []
+        for start, end in self.shards(n_rows):
+            packed = None
+            if mask is not None:
+                if not mask[start:end].any():
+                    continue
+                # One bit per row keeps the task message small
+                packed = np.packbits(mask[start:end])
+            futures.append(executor.submit(_score_shard, path, start, end, queries, packed, k))
+
+        partial = [future.result() for future in futures]
+        if not partial:
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+            return [empty for _ in range(queries.shape[0])]
+        return [merge_top_k([shard[j] for shard in partial], k) for j in range(queries.shape[0])]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,129 @@
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+import numpy as np
+
+# tmpfs keeps the shared arrays in RAM; any local directory works as well
+SHARED_INDEX_DIR = '/dev/shm/shl_recommender'
+_COMPLETE = 'COMPLETE'
+
+
+class SharedArrays:
+    """
+    Read-only arrays shared by every worker process on a node
+
+    Each key (index version, catalog checksum and mode) is a directory of
+    .npy files that every worker maps with `np.load(mmap_mode='r')`, so the
+    pages live once in the page cache instead of once per process. The
+    first process to need a key builds it while holding an exclusive file
+    lock; the others wait on the lock and then attach to what it wrote.
+    """
+
+    def __init__(self, directory, key):
+        self.directory = directory
+        self.key = key
+        self.path = os.path.join(directory, key)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def ready(self):
+        return os.path.exists(os.path.join(self.path, _COMPLETE))
+
+    def _locked(self, operation=fcntl.LOCK_EX):
+        return flock(self.path + '.lock', operation)
+
+    def _write(self, arrays):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(array))
+        open(os.path.join(tmp, _COMPLETE), 'w').close()
+        os.replace(tmp, self.path)
+
+    def _map(self):
+        return {
+            name[:-len('.npy')]: np.load(os.path.join(self.path, name), mmap_mode='r')
+            for name in os.listdir(self.path) if name.endswith('.npy')
+        }
+
+    def _prune(self, keep=1):
+        """
+        Drop keys older than this one and the `keep` most recent others
+
+        A key is only removed while its lock can be taken exclusively, so no
+        process is attaching to or building it at that moment; processes that
+        already map it keep their pages until they unmap. Lock files are never
+        removed, since a process may be waiting on one.
+        """
+        keys = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.lock'):
+                continue
+            key = name.split('.', 1)[0]
+            if key != self.key:
+                keys.setdefault(key, []).append(os.path.join(self.directory, name))
+
+        def age(key):
+            try:
+                return max(os.path.getmtime(path) for path in keys[key])
+            except OSError:
+                return 0.0
+
+        for key in sorted(keys, key=age, reverse=True)[keep:]:
+            with flock(os.path.join(self.directory, f"{key}.lock"), fcntl.LOCK_EX | fcntl.LOCK_NB) as locked:
+                if not locked:
+                    continue
+                for path in keys[key]:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+
+    def attach(self, build):
+        """
+        Map this key's arrays, building them first if no process has yet
+
+        Mapping happens under a shared lock, so a concurrent prune can't
+        remove the directory between the readiness check and the mapping.
+
+        Args:
+            build: Callable returning a dict of name -> array; only called
+                in the process that publishes the key
+
+        Returns:
+            (arrays, built) where arrays maps names to read-only memmaps
+        """
+        with self._locked(fcntl.LOCK_SH):
+            if self.ready:
+                return self._map(), False
+
+        built = False
+        with self._locked(fcntl.LOCK_EX):
+            if not self.ready:
+                shutil.rmtree(self.path, ignore_errors=True)
+                self._write(build())
+                built = True
+            arrays = self._map()
+        if built:
+            self._prune()
+        return arrays, built
+
+
+@contextmanager
+def flock(path, operation):
+    """Hold an flock on `path`; yields False if LOCK_NB was given and the lock is taken"""
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, operation)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
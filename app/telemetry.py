@@ -0,0 +1,246 @@
+import bisect
+import glob
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from result cache hits up to cold encodes of long queries
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_family(name, kind, help_text, samples):
+    """
+    One metric family in the Prometheus text exposition format
+
+    Args:
+        name: Metric name
+        kind: 'counter', 'gauge' or 'histogram'
+        help_text: One-line description
+        samples: (labels dict, value) pairs, or (suffix, labels, value) for
+            histogram series such as '_bucket'
+
+    Returns:
+        The family's lines, newline-terminated
+    """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ('', *sample)
+        lines.append(f"{name}{suffix}{_labels(labels)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+class Histogram:
+    """Latency histogram with cumulative buckets, as Prometheus expects"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        # First bucket whose upper bound is >= value; the last slot is +Inf
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def state(self):
+        """(per-bucket counts, sum, count), e.g. to add up across workers"""
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def samples(self, labels):
+        return histogram_samples(self.buckets, *self.state(), labels)
+
+
+def histogram_samples(buckets, counts, total, count, labels):
+    """The _bucket, _sum and _count series of a histogram from its per-bucket counts"""
+    cumulative = 0
+    for bound, n in zip(tuple(buckets) + (math.inf,), counts):
+        cumulative += n
+        yield '_bucket', {**labels, 'le': _number(bound)}, cumulative
+    yield '_sum', labels, total
+    yield '_count', labels, count
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class StageTimer:
+    """Durations of the stages of one request, for Server-Timing and the histograms"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        # Stages that run several times (one per batch group) accumulate
+        self.stages[stage] = self.stages.get(stage, 0.0) + max(0.0, seconds)
+
+    def update(self, timings):
+        for stage, seconds in timings.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def header(self):
+        """Server-Timing header value, durations in milliseconds"""
+        return ', '.join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in self.stages.items())
+
+
+class Metrics:
+    """
+    Request counts and per-stage latency histograms for one worker process
+
+    Histograms are keyed by endpoint (the route template, so arbitrary paths
+    don't add series) and stage. Gauges such as cache hit rates and queue
+    depth are read from their owners when `render` is called.
+
+    With `directory` set, every worker of a server shares it: `flush` writes
+    this worker's metrics there, and `render` adds up the files of all
+    workers, like Prometheus' multiprocess mode. Counters and histograms are
+    summed, including those of workers that have exited, so totals never go
+    backwards; gauges are reported per live worker under a `worker` label.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS, directory=None):
+        self.buckets = buckets
+        self.directory = directory
+        self.stage_seconds = {}
+        self.requests = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def observe(self, endpoint, timer):
+        """Record every stage of a finished request"""
+        for stage, seconds in timer.stages.items():
+            key = (endpoint, stage)
+            histogram = self.stage_seconds.get(key)
+            if histogram is None:
+                with self._lock:
+                    histogram = self.stage_seconds.setdefault(key, Histogram(self.buckets))
+            histogram.observe(seconds)
+
+    def count(self, endpoint, status):
+        with self._lock:
+            key = (endpoint, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def flush(self, families=()):
+        """Write this worker's metrics and extra families to the shared directory"""
+        if not self.directory:
+            return
+        with self._lock:
+            requests = list(self.requests.items())
+            histograms = list(self.stage_seconds.items())
+        state = {
+            'pid': os.getpid(),
+            'requests': [[e, s, n] for (e, s), n in requests],
+            'stages': [[e, s, *histogram.state()] for (e, s), histogram in histograms],
+            'families': [[name, kind, help_text, [[labels, value] for labels, value in samples]]
+                         for name, kind, help_text, samples in families],
+        }
+        path = os.path.join(self.directory, f"worker-{os.getpid()}.json")
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def _workers(self):
+        states = []
+        for path in sorted(glob.glob(os.path.join(self.directory, 'worker-*.json'))):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    states.append(json.load(f))
+            except (OSError, ValueError):
+                # A worker that exited while its file was being read, or a stray file
+                continue
+        return states
+
+    def _merged(self, families):
+        """Request counts, histogram states and extra families added up over all workers"""
+        self.flush(families)
+        requests, stages, merged = {}, {}, {}
+        for state in self._workers():
+            for e, s, n in state['requests']:
+                requests[(e, s)] = requests.get((e, s), 0) + n
+            for e, s, counts, total, count in state['stages']:
+                previous = stages.get((e, s))
+                if previous is not None:
+                    counts = [a + b for a, b in zip(previous[0], counts)]
+                    total, count = previous[1] + total, previous[2] + count
+                stages[(e, s)] = (counts, total, count)
+
+            alive = _alive(state['pid'])
+            for name, kind, help_text, samples in state['families']:
+                family = merged.setdefault(name, (kind, help_text, {}))[2]
+                for labels, value in samples:
+                    if kind == 'counter':
+                        key = tuple(sorted(labels.items()))
+                        family[key] = (labels, family.get(key, (labels, 0))[1] + value)
+                    elif alive:
+                        labels = {**labels, 'worker': str(state['pid'])}
+                        family[tuple(sorted(labels.items()))] = (labels, value)
+
+        families = [(name, kind, help_text, list(samples.values()))
+                    for name, (kind, help_text, samples) in merged.items()]
+        return sorted(requests.items()), sorted(stages.items()), families
+
+    def render(self, families=()):
+        """
+        Prometheus text for the request metrics plus extra families
+
+        Args:
+            families: (name, kind, help, samples) tuples as taken by format_family
+
+        Returns:
+            The exposition body, for all workers if a shared directory is set
+        """
+        if self.directory:
+            requests, histograms, families = self._merged(families)
+        else:
+            with self._lock:
+                requests = sorted(self.requests.items())
+                histograms = [(key, histogram.state()) for key, histogram in sorted(self.stage_seconds.items())]
+        out = [
+            format_family('shl_requests_total', 'counter', 'Requests served, by endpoint and status',
+                          [({'endpoint': e, 'status': s}, n) for (e, s), n in requests]),
+            format_family('shl_stage_duration_seconds', 'histogram',
+                          'Time spent per request stage (total is the whole request)',
+                          [sample for (e, s), state in histograms
+                           for sample in histogram_samples(self.buckets, *state, {'endpoint': e, 'stage': s})]),
+        ]
+        out.extend(format_family(*family) for family in families)
+        return ''.join(out)
@@ -25,9 +25,9 @@ def clean_recommendations(recommendations: list) -> List[Dict[str, Any]]:
         if "assessment" in rec:
             assessment = rec["assessment"]
             cleaned_assessment = {
-                "url": assessment.get("url", ""),
+                "url": assessment.get("url") or "",
                 "adaptive_support": "Yes" if assessment.get("adaptive_irt_support") else "No",
-                "description": assessment.get("description", ""),
+                "description": assessment.get("description") or "",
                 "duration": parse_duration(assessment.get("duration", "0")) or 0,
                 "remote_support": "Yes" if assessment.get("remote_testing_support") else "No",
                 "test_type": [assessment.get("test_type")] if isinstance(assessment.get("test_type"), str) else assessment.get("test_type", [])
@@ -58,7 +58,7 @@ def get_unique_values(catalog_data: Dict, field: str) -> List[str]:
     """Extract unique values for a given field across all assessments"""
     values = set()
     for assessment in catalog_data.get('assessments', []):
-        if field in assessment:
+        if assessment.get(field) is not None:
             if isinstance(assessment[field], list):
                 values.update(assessment[field])
             else: